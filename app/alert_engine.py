@@ -0,0 +1,89 @@
+import base64
+import threading
+from functools import lru_cache
+from time import time
+
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def alert_audio_html(file='data/chime.wav'):
+    # Encoded once per process instead of on every script run
+    with open(file, 'rb') as f:
+        audio_bytes = f.read()
+    return f"""
+        <audio autoplay=True loop>
+        <source src="data:audio/ogg;base64,{base64.b64encode(audio_bytes).decode()}" type="audio/ogg" autoplay=True>
+        Your browser does not support the audio element.
+        </audio>
+    """
+
+
+class AlertEngine:
+    # Evaluates per-session alert subscriptions once per price snapshot and
+    # keeps the fired alerts around so sessions can poll them cheaply.
+    # Sessions may view different snapshots (e.g. other collections), so each
+    # subscription is evaluated against the snapshot key it subscribed with.
+    # A subscription: dict(dtc_below=..., arb_above=None, max_eth=..., arb_only=False)
+    def __init__(self, subscription_ttl_sec=300):
+        self.subscription_ttl_sec = subscription_ttl_sec
+        self._lock = threading.Lock()
+        self._snapshots = {}  # snapshot key -> arrays used by _evaluate
+        self._subscriptions = {}  # session_id -> (subscription, snapshot key, last seen)
+        self._fired = {}  # session_id -> list of fired item names
+
+    def on_snapshot(self, key, prices):
+        with self._lock:
+            if key in self._snapshots:
+                return
+            self._snapshots[key] = dict(
+                names=prices['Name'].values,
+                os_eth=prices['OS ETH'].values.astype(float),
+                dtc=prices['DTC'].values.astype(float),
+                arb=prices['Arb'].values.astype(float),
+            )
+            self._expire_subscriptions()
+            for session_id, (sub, sub_key, _) in self._subscriptions.items():
+                if sub_key == key:
+                    self._fired[session_id] = self._evaluate(sub, key)
+            # Snapshots no session is looking at any more
+            in_use = {sub_key for _, sub_key, _ in self._subscriptions.values()}
+            for old_key in [k for k in self._snapshots if k != key and k not in in_use]:
+                del self._snapshots[old_key]
+
+    def subscribe(self, session_id, snapshot_key, **subscription):
+        with self._lock:
+            old = self._subscriptions.get(session_id)
+            self._subscriptions[session_id] = (subscription, snapshot_key, time())
+            if old is None or old[0] != subscription or old[1] != snapshot_key:
+                self._fired[session_id] = self._evaluate(subscription, snapshot_key)
+
+    def poll(self, session_id):
+        with self._lock:
+            if session_id in self._subscriptions:
+                sub, sub_key, _ = self._subscriptions[session_id]
+                self._subscriptions[session_id] = (sub, sub_key, time())
+            return self._fired.get(session_id, [])
+
+    def _evaluate(self, subscription, snapshot_key):
+        snapshot = self._snapshots.get(snapshot_key)
+        if snapshot is None:
+            return []
+        with np.errstate(invalid='ignore'):
+            wanted = snapshot['dtc'] < subscription['dtc_below']
+            if subscription.get('arb_above') is not None:
+                wanted |= snapshot['arb'] > subscription['arb_above']
+            if subscription.get('max_eth') is not None:
+                wanted &= snapshot['os_eth'] <= subscription['max_eth']
+            if subscription.get('arb_only'):
+                wanted &= snapshot['arb'] > 0
+        return snapshot['names'][wanted].tolist()
+
+    def _expire_subscriptions(self):
+        now = time()
+        for session_id in [s for s, (_, _, seen) in self._subscriptions.items() if now - seen > self.subscription_ttl_sec]:
+            del self._subscriptions[session_id]
+            self._fired.pop(session_id, None)
+
+
+alert_engine = AlertEngine()
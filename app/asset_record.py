@@ -0,0 +1,55 @@
+def gala_base_id(calldata):
+    return f'0x{calldata[166:][:36]}'
+
+
+class Payment:
+    # A sell order or last sale: amount in the payment token's smallest unit, the token's
+    # symbol, decimals and USD/ETH rates, and quantity. base_id is the Gala item of a sell order.
+    __slots__ = ('amount', 'symbol', 'decimals', 'usd_rate', 'eth_rate', 'quantity', 'base_id')
+
+    def __init__(self, amount, symbol, decimals, usd_rate, eth_rate, quantity, base_id=None):
+        self.amount = amount
+        self.symbol = symbol
+        self.decimals = decimals
+        self.usd_rate = usd_rate
+        self.eth_rate = eth_rate
+        self.quantity = quantity
+        self.base_id = base_id
+
+    @classmethod
+    def from_opensea(cls, data, amount_key, token_key):
+        token = data[token_key]
+        return cls(float(data[amount_key]), token.get('symbol'), token['decimals'], float(token['usd_price']),
+                   float(token['eth_price']), int(data['quantity']))
+
+
+class AssetRecord:
+    # The fields of an OpenSea asset that pricing, filtering and the token catalog use
+    __slots__ = ('token_id', 'name', 'permalink', 'traits', 'sell_orders', 'last_sale')
+
+    def __init__(self, token_id, name, permalink, traits, sell_orders, last_sale):
+        self.token_id = token_id
+        self.name = name
+        self.permalink = permalink
+        self.traits = traits
+        self.sell_orders = sell_orders
+        self.last_sale = last_sale
+
+    @classmethod
+    def from_opensea(cls, a):
+        sell_orders = []
+        for so in a.get('sell_orders') or []:
+            order = Payment.from_opensea(so, 'current_price', 'payment_token_contract')
+            order.base_id = gala_base_id(so['calldata'])
+            sell_orders.append(order)
+        last_sale = a.get('last_sale')
+        return cls(
+            str(a['token_id']),
+            a.get('name'),
+            a.get('permalink'),
+            {t['trait_type']: t['value'] for t in a.get('traits') or [] if 'trait_type' in t},
+            sell_orders,
+            Payment.from_opensea(last_sale, 'total_price', 'payment_token') if last_sale else None)
+
+    def __repr__(self):
+        return f'AssetRecord({self.token_id}, {self.name!r})'
@@ -1,6 +1,11 @@
 
 import os
+import json
+import socket
 import sqlite3
+import threading
+from uuid import uuid4
+from time import time
 from datetime import datetime
 from contextlib import contextmanager
 
@@ -9,32 +14,63 @@ class ProcessRegistryError(Exception):
     pass
 
 
+def lease_owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+
+
+def is_owner_dead(owner):
+    # Only processes on this host can be checked; elsewhere the lease has to expire
+    host, pid, _ = owner.split(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
 @contextmanager
-def BackgroundState(process_name):
-    print(f'Background state: {process_name} waiting for DB...')
+def BackgroundState(name, job=None):
+    # Holds the lease on name (a dataset, or a job without one) while the block runs. A
+    # heartbeat thread renews it; leases of killed jobs expire, or are taken over right
+    # away when their process is gone. Jobs on other names run in parallel.
     bs = BackgroundStateDB()
-    with bs.connection:  # lock table
-        print(f'Background state: {process_name} entered DB')
-        c = bs.cursor
-        c.execute(f'SELECT * FROM {bs.table_name} WHERE process_name = "{process_name}"')
-        sel_res = c.fetchall()
-        if len(sel_res) > 0:
-            raise ProcessRegistryError(f'Already registered: {sel_res}')
-        time_now_str = datetime.now().isoformat()
-        c.execute(
-            f'INSERT INTO {bs.table_name} (process_name, start_time) VALUES ("{process_name}", "{time_now_str}")')
-        bs.connection.commit()
-        try:
-            yield bs
-        finally:
-            c.execute(f'DELETE FROM {bs.table_name} WHERE process_name = "{process_name}"')
-            bs.connection.commit()
-    print(f'Background state: {process_name} exited DB')
+    owner = lease_owner()
+    if not bs.acquire_lease(name, owner, job or name):
+        raise ProcessRegistryError(f'Already leased: {bs.get_lease(name)}')
+    print(f'Background state: {job or name} leased {name}')
+    stop = threading.Event()
+
+    def heartbeat():
+        hb = BackgroundStateDB()
+        while not stop.wait(hb.lease_ttl_sec / 3):
+            if not hb.renew_lease(name, owner):
+                print(f'Background state: lost lease on {name}')
+                return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        yield bs
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+        bs.release_lease(name, owner)
+        print(f'Background state: {job or name} released {name}')
 
 
 class BackgroundStateDB:
     filename = 'bg_state.sqlite3'
-    table_name = 'background_state'
+    lease_table_name = 'lease'
+    lease_columns = ['name', 'owner', 'job', 'acquired_at', 'expires_at']
+    lease_ttl_sec = 30
+    dataset_table_name = 'dataset_state'
+    dataset_columns = ['dataset', 'last_update', 'row_count', 'content_hash', 'inputs']
+    refresh_table_name = 'refresh_request'
+    _local = threading.local()
 
     def __init__(self):
         self._connection = None
@@ -51,20 +87,129 @@ class BackgroundStateDB:
         return self._cursor
 
     def destroy_db(self):
-        if os.path.isfile(self.filename):
-            os.remove(self.filename)
+        self._local.__dict__.clear()
+        for file in [self.filename, f'{self.filename}-wal', f'{self.filename}-shm']:
+            if os.path.isfile(file):
+                os.remove(file)
 
     def init_db(self):
         if self._connection is not None:
             return
-        conn = sqlite3.connect(self.filename)
+        # Instances in the same thread share one connection, so the schema setup below
+        # runs once per thread and lookups are a single query
+        key = (os.getpid(), self.filename)
+        if getattr(self._local, 'key', None) != key:
+            self._local.connection = self._connect()
+            self._local.key = key
+        self._connection = self._local.connection
+        self._cursor = self._connection.cursor()
+
+    def _connect(self):
+        # Waits for other writers instead of failing with "database is locked"
+        conn = sqlite3.connect(self.filename, timeout=30)
         cursor = conn.cursor()
-        cursor.execute(f'CREATE TABLE IF NOT EXISTS {self.table_name}(process_name TEXT, start_time TIMESTAMP)')
+        # Readers (the UI) do not block the jobs writing, and the other way round
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # One row per running job; expires_at (epoch seconds) is pushed forward by its heartbeat
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.lease_table_name}('
+            'name TEXT PRIMARY KEY, owner TEXT, job TEXT, acquired_at REAL, expires_at REAL)')
+        # Freshness registry: one row per dataset so readers never have to open data files
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.dataset_table_name}('
+            'dataset TEXT PRIMARY KEY, last_update TIMESTAMP, row_count INTEGER, content_hash TEXT, inputs TEXT)')
+        if 'inputs' not in [row[1] for row in cursor.execute(f'PRAGMA table_info({self.dataset_table_name})')]:
+            # DB from before input tracking
+            cursor.execute(f'ALTER TABLE {self.dataset_table_name} ADD COLUMN inputs TEXT')
+        # On-demand refresh requests for the scheduler; one row per dataset merges duplicate triggers
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.refresh_table_name}('
+            'dataset TEXT PRIMARY KEY, job TEXT, args TEXT, requested_at TIMESTAMP)')
         conn.commit()
-        self._connection = conn
-        self._cursor = cursor
+        return conn
     
-    def list_processes(self):
+    def acquire_lease(self, name, owner, job):
+        now = time()
+        with self.connection:
+            c = self.cursor
+            lease = self.get_lease(name, live_only=False)
+            if lease is not None and is_owner_dead(lease['owner']):
+                print(f'Background state: taking over {name} from dead {lease["owner"]}')
+                c.execute(f'DELETE FROM {self.lease_table_name} WHERE name = ? AND owner = ?', (name, lease['owner']))
+            # Takes the lease if it is free or expired, in one statement so racing jobs cannot both get it
+            c.execute(
+                f'INSERT INTO {self.lease_table_name} (name, owner, job, acquired_at, expires_at) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET '
+                'owner = excluded.owner, job = excluded.job, acquired_at = excluded.acquired_at, '
+                'expires_at = excluded.expires_at WHERE expires_at < excluded.acquired_at',
+                (name, owner, job, now, now + self.lease_ttl_sec))
+            return c.rowcount == 1
+
+    def renew_lease(self, name, owner):
+        with self.connection:
+            self.cursor.execute(
+                f'UPDATE {self.lease_table_name} SET expires_at = ? WHERE name = ? AND owner = ?',
+                (time() + self.lease_ttl_sec, name, owner))
+            return self.cursor.rowcount == 1
+
+    def release_lease(self, name, owner):
+        with self.connection:
+            self.cursor.execute(f'DELETE FROM {self.lease_table_name} WHERE name = ? AND owner = ?', (name, owner))
+
+    def get_lease(self, name, live_only=True):
         c = self.cursor
-        c.execute(f'SELECT * FROM {self.table_name}')
-        return c.fetchall()
\ No newline at end of file
+        c.execute(f'SELECT {", ".join(self.lease_columns)} FROM {self.lease_table_name} WHERE name = ?', (name,))
+        row = c.fetchone()
+        lease = None if row is None else dict(zip(self.lease_columns, row))
+        if live_only and lease is not None and (lease['expires_at'] < time() or is_owner_dead(lease['owner'])):
+            return None
+        return lease
+
+    def list_leases(self):
+        c = self.cursor
+        c.execute(f'SELECT name FROM {self.lease_table_name}')
+        return [lease for lease in (self.get_lease(name) for name, in c.fetchall()) if lease is not None]
+
+    def record_dataset_update(self, dataset, last_update, row_count, content_hash):
+        with self.connection:
+            self.cursor.execute(
+                f'INSERT INTO {self.dataset_table_name} (dataset, last_update, row_count, content_hash) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT(dataset) DO UPDATE SET '
+                'last_update = excluded.last_update, row_count = excluded.row_count, '
+                'content_hash = excluded.content_hash',
+                (dataset, last_update, row_count, content_hash))
+
+    def record_dataset_inputs(self, dataset, inputs):
+        # Content hashes of the datasets this one was computed from
+        with self.connection:
+            self.cursor.execute(
+                f'INSERT INTO {self.dataset_table_name} (dataset, inputs) VALUES (?, ?) '
+                'ON CONFLICT(dataset) DO UPDATE SET inputs = excluded.inputs',
+                (dataset, json.dumps(inputs, sort_keys=True)))
+
+    def get_dataset_state(self, dataset):
+        c = self.cursor
+        c.execute(f'SELECT {", ".join(self.dataset_columns)} FROM {self.dataset_table_name} WHERE dataset = ?',
+                  (dataset,))
+        row = c.fetchone()
+        return None if row is None else dict(zip(self.dataset_columns, row))
+
+    def list_dataset_states(self):
+        c = self.cursor
+        c.execute(f'SELECT {", ".join(self.dataset_columns)} FROM {self.dataset_table_name}')
+        return [dict(zip(self.dataset_columns, row)) for row in c.fetchall()]
+
+    def request_refresh(self, job, args=()):
+        with self.connection:
+            self.cursor.execute(
+                f'INSERT OR REPLACE INTO {self.refresh_table_name} (dataset, job, args, requested_at) '
+                'VALUES (?, ?, ?, ?)',
+                (args[0] if args else job, job, json.dumps(list(args)), datetime.now().isoformat()))
+
+    def pop_refresh_requests(self):
+        with self.connection:
+            c = self.cursor
+            c.execute(f'SELECT job, args FROM {self.refresh_table_name}')
+            refresh_requests = [(job, json.loads(args)) for job, args in c.fetchall()]
+            c.execute(f'DELETE FROM {self.refresh_table_name}')
+        return refresh_requests
@@ -1,21 +1,54 @@
 import sys
-import requests
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import time, sleep
 from datetime import datetime
 
 from util import *
 from background_state import *
+from rate_limit import HostGovernor, host_limits
+from token_catalog import TokenCatalog
+from metrics import span, assets_per_run, start_metrics_server
+from dataflow import Dataflow, Stage, MissingInput
 
 
 def update_coin_prices(coin_prices_csv, *coins):
     coins_str = ','.join(coins)
-    r = requests.get(url=f'https://api.coingecko.com/api/v3/simple/price?ids={coins_str}&vs_currencies=usd')
-    assert r.status_code == 200
-    df = pd.DataFrame([(k, v['usd']) for k, v in r.json().items()], columns=['coin', 'usd'])
+    data = http_session.get_json(f'{coingecko_api_url}/simple/price?ids={coins_str}&vs_currencies=usd',
+                                 cache=True)
+    df = pd.DataFrame([(k, v['usd']) for k, v in data.items()], columns=['coin', 'usd'])
     df['LastUpdate'] = datetime.now().isoformat()
-    df.to_csv(coin_prices_csv, index=False)
+    save_dataset(df, coin_prices_csv, index_col='coin')
+    if coin_prices_csv == default_coin_prices_csv:
+        published_snapshots.publish(df, coin_prices_view)
 
 
-def update_nft_rewards(nft_rewards_csv):
+def update_nft_rewards(nft_rewards_csv, collection='town-star'):
+    reward_source = tracked_collections[collection].reward_source
+    df = reward_sources[reward_source]()
+    df['LastUpdate'] = datetime.now().isoformat()
+    save_dataset(df, nft_rewards_csv, index_col='name')
+
+
+def publish_prices_view(prices_view, collection='town-star'):
+    # Prices with the derived Reward/DTC columns, so viewers only have to map them
+    c = tracked_collections[collection]
+    prices = require_input(c.nft_prices_csv)
+    coin_prices = require_input(default_coin_prices_csv)
+    rewards = require_input(c.nft_rewards_csv) if c.reward_source else None
+    reward_usd = get_coin_price(coin_prices, c.reward_coin) if c.reward_coin in coin_prices.coin.values else nan
+    with span('publish'):
+        # USD values follow the latest coin prices without refetching
+        prices = reprice_nft_prices(prices, coin_prices)
+        prices = add_reward_columns(prices, rewards, reward_usd)
+        published_snapshots.publish(prices, prices_view)
+    with span('history'):
+        price_history.add(collection, prices)
+
+
+def fetch_nftlookup_townstar_rewards():
     nftlookup_io = initialize_nftlookup_io()
     h = {
         'authority': 'nftlookup.io',
@@ -31,42 +64,290 @@ def update_nft_rewards(nft_rewards_csv):
     data = ('method=getTempTableInfo&curJson=%7B%22BasedOn%22%3A%22Items%22%2C%22DashBoardItemName%22%3A%22NFT+Rewards+for+Townstar+(Vox+%26+Townstar+NFT)%22%2C%22DashBoardItemDescription%22%3A%22This+dashboard+will+give+you+all+NFT\'s+that+are+used+in+Townstar%2C+ordered+by+their+rarity.+It+includes+as+well+the+current+price+on+the+market%22%2C%22DashboardID%22%3A%22-1%22%2C%22IsItemActivated%22%3A%221%22%2C%22Collections%22%3A%5B%22collectvox%22%2C%22town-star%22%5D%2C%22CollectionItems%22%3A%5B%5D%2C%22SelectFields%22%3A%5B%22itemname%22%2C%22colname%22%2C%22itemrarityscore%22%2C%22reppricelowETH%22%5D%2C%22Statements%22%3A%5B%5D%2C%22Footer%22%3A%5B%5D%2C%22FinalStatements%22%3A%5B%22itemname%22%2C%22colname%22%2C%22itemrarityscore%22%2C%22reppricelowETH%22%5D%2C%22OrderBy%22%3A%5B%22itemrarityscoreDesc%22%5D%2C%22LimitQuery%22%3A%5B%7B%22AndOr%22%3A%22And%22%2C%22FieldName%22%3A%22itemrarityscore%22%2C%22Type%22%3A%22Number%22%2C%22Operator%22%3A%22%3E%22%2C%22Value%22%3A%220%22%7D%5D%2C%22isGraph%22%3A%220%22%2C%22GraphType%22%3A%22%22%2C%22GraphTitle%22%3A%22%22%2C%22GraphLabel%22%3A%22%22%2C%22GraphValues%22%3A%22%22%2C%22isShowDetailsButton%22%3A%221%22%2C%22Alert%22%3A%5B%5D%7D&'
             f'curToken={nftlookup_io["curToken"]}')
 
-    while True:
-        r = requests.post(url='https://nftlookup.io/nftlookup/GeneralComponents/DatabaseFunctions.cfc',
-                          headers=h, data=data)
-        if r.status_code == 200:
-            break
-        print(f'Failed to fetch rewards: {r.reason}, waiting...')
-        sleep(60)
+    r = http_session.post(url=f'{nftlookup_url}/GeneralComponents/DatabaseFunctions.cfc',
+                          headers=h, data=data, max_retries=config.get('nftlookup_max_retries', 10))
+    assert r.status_code == 200, f'Failed to fetch rewards: {r.reason}'
     r_data = r.json()
-    df = pd.DataFrame(r_data['TableData'], columns=[v['title'] for v in r_data['TableColumns']])\
+    return pd.DataFrame(r_data['TableData'], columns=[v['title'] for v in r_data['TableColumns']])\
         .rename(columns={
             'Item Name': 'name',
             'Rarity (Rewards)': 'reward'
         })
-    df['LastUpdate'] = datetime.now().isoformat()
-    df.to_csv(nft_rewards_csv, index=False)
 
 
-def update_nft_prices(nft_prices_csv, nft_rewards_csv, coin_prices_csv, force_update_token_ids):
-    token_ids = []
-    if not force_update_token_ids and os.path.isfile(nft_prices_csv):
-        token_ids = pd.read_csv(nft_prices_csv).token_id.values
+# Collection registry reward_source -> function returning a (name, reward) frame
+reward_sources = {
+    'nftlookup_townstar': fetch_nftlookup_townstar_rewards,
+}
+
+
+def load_reward_item_names(c, nft_rewards_csv):
+    if not c.reward_source:
+        return None
     # need reward names to filter opensea items
-    rewards = load_file(nft_rewards_csv, load_func=pd.read_csv, patient=True)
-    reward_item_names = lowertrim(rewards.name).values
-    assets = fetch_opensea_assets(reward_item_names, token_ids=token_ids)
-    coin_prices = load_file(coin_prices_csv, load_func=pd.read_csv, patient=True)
-    prices = get_nft_prices(assets, coin_prices)
-    prices['LastUpdate'] = datetime.now().isoformat()
-    prices.to_csv(nft_prices_csv, index=False)
+    rewards = require_input(nft_rewards_csv)
+    return lowertrim(rewards.name).values
+
+
+def fetch_collection_assets(c, catalog, reward_item_names, token_ids=[], known_token_ids=None):
+    # Fetches the given tokens (or walks the collection for new ones), records every asset
+    # seen in the token catalog and returns those that pass the collection's filters
+    reward_index = None if reward_item_names is None else NameIndex(reward_item_names)
+    seen_at = datetime.now().isoformat()
+    wanted_assets = []
+    for assets in fetch_opensea_pages(
+            token_ids, collection=c.collection, contract_address=c.contract_address, known_token_ids=known_token_ids):
+        catalog.upsert([catalog_record(a) for a in assets], seen_at)
+        wanted_assets.extend(filter_opensea_assets(assets, reward_index, c.trait_filter))
+    return wanted_assets
+
+
+def update_nft_prices(nft_prices_csv, nft_rewards_csv, coin_prices_csv, force_update_token_ids, incremental='',
+                      collection='town-star'):
+    c = tracked_collections[collection]
+    start_time = time()
+    delta_state_json = os.path.splitext(nft_prices_csv)[0] + '_delta.json'
+    delta_state = read_json(delta_state_json) if os.path.isfile(delta_state_json) else {}
+    full_scan_due = start_time - delta_state.get('last_full_scan', 0) > config.get('nft_prices_full_scan_interval', 1800)
+    if incremental and not force_update_token_ids and not full_scan_due and os.path.isfile(nft_prices_csv):
+        if update_nft_prices_incremental(c, nft_prices_csv, nft_rewards_csv, coin_prices_csv,
+                                         delta_state['last_event_check']):
+            delta_state['last_event_check'] = start_time
+            write_json(delta_state_json, delta_state)
+            return
+
+    with span('load_inputs'):
+        catalog = TokenCatalog(c.token_catalog_csv)
+        reward_item_names = load_reward_item_names(c, nft_rewards_csv)
+    # Discovery walks the collection newest first and stops at known tokens; only an
+    # empty catalog needs the walk over the whole collection
+    last_discovery = delta_state.get('last_discovery', 0)
+    discovered_assets = []
+    if force_update_token_ids or len(catalog) == 0 or \
+            start_time - last_discovery > config.get('token_discovery_interval', 3600):
+        with span('discover'):
+            known_token_ids = set(catalog.token_ids())
+            discovered_assets = fetch_collection_assets(c, catalog, reward_item_names, known_token_ids=known_token_ids)
+            print(f'Discovery: {len(catalog) - len(known_token_ids)} new tokens')
+        last_discovery = start_time
+    with span('fetch_assets'):
+        discovered_token_ids = {a.token_id for a in discovered_assets}
+        name_filter = None if reward_item_names is None else NameIndex(reward_item_names).has_substring
+        token_ids = [ti for ti in catalog.select(name_filter, c.trait_filter) if ti not in discovered_token_ids]
+        assets = discovered_assets + (fetch_collection_assets(c, catalog, reward_item_names, token_ids) if token_ids else [])
+        catalog.save()
+    assets_per_run.labels(c.name, 'full').observe(len(assets))
+    with span('pricing'):
+        coin_prices = require_input(coin_prices_csv)
+        prices = get_nft_prices(assets, coin_prices, catalog.base_ids())
+    with span('save'):
+        prices['LastUpdate'] = datetime.now().isoformat()
+        save_dataset(prices, nft_prices_csv, index_col='token_id')
+    write_json(delta_state_json, dict(last_full_scan=start_time, last_event_check=start_time, last_discovery=last_discovery))
+
+
+def update_nft_prices_incremental(c, nft_prices_csv, nft_rewards_csv, coin_prices_csv, last_event_check):
+    # Reprice only tokens with OpenSea events since the last check and merge them into the
+    # latest snapshot. Returns False if the change feed could not be used (full scan needed).
+    # Overlap the window a little so late-indexed events are not missed
+    with span('event_check'):
+        changed_token_ids = fetch_opensea_changed_token_ids(
+            last_event_check - 60, collection=c.collection, contract_address=c.contract_address)
+    if changed_token_ids is None:
+        return False
+    with span('load_inputs'):
+        prev_prices = pd.read_csv(nft_prices_csv, dtype={'token_id': str})
+        catalog = TokenCatalog(c.token_catalog_csv)
+    # Tokens the catalog has not seen yet are new and get discovered here; other
+    # catalogued tokens are not priced (they did not pass the filters)
+    tracked_token_ids = set(prev_prices.token_id)
+    changed_token_ids = [ti for ti in changed_token_ids if ti in tracked_token_ids or ti not in catalog]
+    print(f'Incremental update: {len(changed_token_ids)} changed tokens')
+    assets_per_run.labels(c.name, 'incremental').observe(len(changed_token_ids))
+    prices = prev_prices
+    if changed_token_ids:
+        with span('fetch_assets'):
+            assets = fetch_collection_assets(
+                c, catalog, load_reward_item_names(c, nft_rewards_csv), changed_token_ids)
+            catalog.save()
+        with span('pricing'):
+            coin_prices = require_input(coin_prices_csv)
+            changed_prices = get_nft_prices(assets, coin_prices, catalog.base_ids())
+        changed_prices['token_id'] = changed_prices.token_id.astype(str)
+        # Keep the previous row order with new tokens last; changed rows replace their old versions
+        prices = pd.concat([prev_prices.set_index('token_id'), changed_prices.set_index('token_id')])
+        prices = prices[~prices.index.duplicated(keep='last')]
+        prices = prices.loc[
+            list(prev_prices.token_id[prev_prices.token_id.isin(prices.index)]) +
+            [ti for ti in changed_prices.token_id if ti not in tracked_token_ids]].reset_index()
+    with span('save'):
+        prices['LastUpdate'] = datetime.now().isoformat()
+        save_dataset(prices, nft_prices_csv, index_col='token_id')
+    return True
+
+
+def build_dataflow():
+    stages = [Stage(default_coin_prices_csv, 'update_coin_prices', [default_coin_prices_csv, *tracked_coins])]
+    for c in tracked_collections.values():
+        rewards = [c.nft_rewards_csv] if c.reward_source else []
+        if c.reward_source:
+            stages.append(Stage(c.nft_rewards_csv, 'update_nft_rewards', [c.nft_rewards_csv, c.name]))
+        # Rewards decide which assets are priced; coin prices only move USD values, which
+        # the view reprices, so prices need them but are not refetched when they change
+        stages.append(Stage(
+            c.nft_prices_csv, 'update_nft_prices',
+            [c.nft_prices_csv, c.nft_rewards_csv, default_coin_prices_csv, '', '', c.name],
+            inputs=rewards, requires=[default_coin_prices_csv]))
+        stages.append(Stage(
+            c.prices_view, 'publish_prices_view', [c.prices_view, c.name],
+            inputs=[c.nft_prices_csv, *rewards, default_coin_prices_csv], inline=True))
+    return Dataflow(stages, BackgroundStateDB)
+
+
+dataflow = build_dataflow()
+
+
+def require_input(file, load_func=pd.read_csv):
+    # Instead of waiting for a missing input, ask for it and give up this run; the
+    # dataflow reruns this stage once the input is there
+    df = load_file(file, load_func=load_func)
+    if df is None:
+        stage = dataflow.stages.get(file)
+        if stage is not None and not dataflow.is_running(stage):
+            BackgroundStateDB().request_refresh(stage.job, stage.args)
+        raise MissingInput(file)
+    return df
+
+
+def run_job(func_name, *args):
+    # First argument of every update function is the dataset file it writes; jobs
+    # hold a lease on it, so jobs on different datasets run in parallel
+    dataset = args[0] if args else None
+    stage = dataflow.stages.get(dataset)
+    try:
+        with BackgroundState(dataset or func_name, func_name):
+            # Inputs as of the start, so changes made while running still count as new
+            input_hashes = dataflow.input_hashes(stage) if stage else None
+            with span(func_name):
+                globals()[func_name](*args)
+            if stage:
+                dataflow.record_inputs(stage, input_hashes)
+    except ProcessRegistryError as e:
+        print(f'Process error: {func_name}; ({e})')
+        return
+    except MissingInput as e:
+        print(f'{func_name}({dataset}): input not there yet: {e}')
+        return
+    if stage is not None and dataflow.is_stale(stage):
+        # Inputs changed while it ran (stale checks skip running stages)
+        print(f'Dataflow: inputs of {stage} changed while running')
+        recompute(stage)
+    if dataset:
+        propagate(dataset)
+
+
+def propagate(dataset):
+    # Recomputes what depends on dataset and is now stale
+    for stage in dataflow.downstream(dataset):
+        if dataflow.is_stale(stage):
+            print(f'Dataflow: {dataset} changed, recomputing {stage}')
+            recompute(stage)
+
+
+def recompute(stage):
+    # Cheap stages run right here, the rest through the scheduler
+    if stage.inline:
+        run_job(stage.job, *stage.args)
+    else:
+        BackgroundStateDB().request_refresh(stage.job, stage.args)
+
+
+def init_worker(governor):
+    http_session.governor = governor
+
+
+def scheduler():
+    # Long-lived mode: runs each dataset's update on its own interval, plus on demand
+    # from the UI. Jobs run in a pool of long-lived worker processes (one per job), so
+    # interpreters, HTTP pools and caches stay warm, and share per-host rate limits.
+    intervals = config.get('scheduler_intervals', {})
+    jobs = {
+        default_coin_prices_csv: ('update_coin_prices', [default_coin_prices_csv, *tracked_coins],
+                                  intervals.get('update_coin_prices', 30))
+    }
+    for c in tracked_collections.values():
+        if c.reward_source:
+            jobs[c.nft_rewards_csv] = ('update_nft_rewards', [c.nft_rewards_csv, c.name], c.rewards_refresh_interval)
+        jobs[c.nft_prices_csv] = (
+            'update_nft_prices',
+            [c.nft_prices_csv, c.nft_rewards_csv, default_coin_prices_csv, '', '1', c.name],
+            c.refresh_interval)
+    # Single instance: the lease is taken before anything is started or published
+    with BackgroundState('scheduler') as bs:
+        for c in tracked_collections.values():
+            os.makedirs(c.data_dir, exist_ok=True)
+        # Views for data that is already there, so viewers need not derive them
+        if os.path.isfile(default_coin_prices_csv):
+            published_snapshots.publish(pd.read_csv(default_coin_prices_csv), coin_prices_view)
+        for stage in dataflow.stages.values():
+            if stage.inline and dataflow.is_stale(stage):
+                run_job(stage.job, *stage.args)
+
+        mp_context = multiprocessing.get_context('spawn')
+        governor = HostGovernor(host_limits(config.get('rate_limits', {})), ctx=mp_context)
+        pool_lock = threading.Lock()
+        pool = [None]
+
+        def get_pool(broken=None):
+            with pool_lock:
+                if pool[0] is None or pool[0] is broken:
+                    pool[0] = ProcessPoolExecutor(
+                        max_workers=len(jobs), mp_context=mp_context, initializer=init_worker, initargs=(governor,))
+                return pool[0]
+
+        # Triggers that arrive while a job is queued or running collapse into one run
+        triggers = {dataset: threading.Event() for dataset in jobs}
+        pending_args = {}
+        pending_lock = threading.Lock()
+
+        def worker(dataset, func_name, default_args, interval_sec):
+            while True:
+                triggers[dataset].wait(timeout=interval_sec)
+                triggers[dataset].clear()
+                with pending_lock:
+                    args = pending_args.pop(dataset, default_args)
+                job_pool = get_pool()
+                try:
+                    job_pool.submit(run_job, func_name, *args).result()
+                except BrokenProcessPool:
+                    print(f'Scheduler: worker died running {func_name}({dataset}); restarting pool')
+                    get_pool(broken=job_pool)
+                except Exception as e:
+                    print(f'Scheduler: {func_name}({dataset}) failed: {e!r}')
+
+        for dataset, (func_name, args, interval_sec) in jobs.items():
+            if has_expired(dataset, interval_sec):
+                triggers[dataset].set()
+            threading.Thread(target=worker, args=(dataset, func_name, args, interval_sec), daemon=True).start()
+
+        start_metrics_server(config.get('metrics_port', 9108), BackgroundStateDB)
+        print(f'Scheduler: running {", ".join(f"{j[0]}({d})" for d, j in jobs.items())}')
+        while True:
+            for func_name, args in bs.pop_refresh_requests():
+                dataset = args[0] if args else None
+                if dataset not in triggers or jobs[dataset][0] != func_name:
+                    print(f'Scheduler: ignoring unknown job {func_name}({dataset})')
+                    continue
+                with pending_lock:
+                    pending_args[dataset] = args
+                triggers[dataset].set()
+            sleep(1)
 
 
 if __name__ == '__main__':
     assert len(sys.argv) > 1, 'Provide function name'
     func_name = sys.argv[1]
-    with BackgroundState(func_name):
-        try:
-            locals()[func_name](*sys.argv[2:])
-        except ProcessRegistryError as e:
-            print(f'Process error: {func_name}; ({e})')
+    if func_name == 'scheduler':
+        scheduler(*sys.argv[2:])
+    else:
+        run_job(func_name, *sys.argv[2:])
@@ -0,0 +1,49 @@
+import os
+
+# Built-in collections; config.json 'collections' can override fields or add more, e.g.
+#   "collections": {"my-collection": {"contract_address": "0x...", "trait_filter": {}, "reward_source": null}}
+default_collections = {
+    'town-star': dict(
+        collection='town-star',
+        contract_address='0xc36cf0cfcb5d905b8b513860db0cfe63f6cf9f5c',
+        trait_filter={'game': 'Town Star'},
+        reward_source='nftlookup_townstar',
+        reward_coin='town-star',
+        refresh_interval=60,
+        rewards_refresh_interval=3600,
+    ),
+}
+
+
+class Collection:
+    def __init__(self, name, data_dir, collection=None, contract_address=None, trait_filter=None,
+                 reward_source=None, reward_coin=None, refresh_interval=60, rewards_refresh_interval=3600):
+        self.name = name
+        self.collection = collection or name
+        self.contract_address = contract_address
+        self.trait_filter = trait_filter or {}
+        self.reward_source = reward_source
+        self.reward_coin = reward_coin
+        self.refresh_interval = refresh_interval
+        self.rewards_refresh_interval = rewards_refresh_interval
+        self.data_dir = os.path.join(data_dir, name)
+        self.nft_prices_csv = os.path.join(self.data_dir, 'nft_prices.csv')
+        self.nft_rewards_csv = os.path.join(self.data_dir, 'nft_rewards.csv')
+        self.token_catalog_csv = os.path.join(self.data_dir, 'token_catalog.csv')
+        # Published prices with Reward/DTC, as read by the UI
+        self.prices_view = f'{name}/nft_prices_view'
+
+    def __repr__(self):
+        return f'Collection({self.name})'
+
+
+def load_collections(config, data_dir='data'):
+    specs = {k: dict(v) for k, v in default_collections.items()}
+    for name, spec in config.get('collections', {}).items():
+        specs.setdefault(name, {}).update(spec)
+    return {name: Collection(name, data_dir, **spec) for name, spec in specs.items()}
+
+
+def shared_coin_prices_csv(data_dir='data'):
+    # Coin prices are shared by all collections
+    return os.path.join(data_dir, 'coin_prices.csv')
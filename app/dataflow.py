@@ -0,0 +1,57 @@
+import json
+
+
+class MissingInput(Exception):
+    pass
+
+
+class Stage:
+    # One dataset and the job that produces it. Changes to `inputs` make it stale;
+    # `requires` must exist for the job to run, but changes to them do not.
+    # Inline stages are cheap enough to run right after their inputs change.
+    def __init__(self, output, job, args, inputs=(), requires=(), inline=False):
+        self.output = output
+        self.job = job
+        self.args = list(args)
+        self.inputs = list(inputs)
+        self.requires = list(requires)
+        self.inline = inline
+
+    def __repr__(self):
+        return f'Stage({self.job}({self.output}))'
+
+
+class Dataflow:
+    # Dependency graph between datasets. Each stage records the content hashes of the
+    # inputs it was computed from, so downstream work is skipped while they are unchanged.
+    def __init__(self, stages, state_db_factory):
+        self.stages = {s.output: s for s in stages}
+        self.state_db_factory = state_db_factory
+
+    def input_hashes(self, stage):
+        db = self.state_db_factory()
+        hashes = {}
+        for dataset in stage.inputs:
+            state = db.get_dataset_state(dataset)
+            hashes[dataset] = None if state is None else state['content_hash']
+        return hashes
+
+    def record_inputs(self, stage, hashes):
+        self.state_db_factory().record_dataset_inputs(stage.output, hashes)
+
+    def is_running(self, stage):
+        # A stage's job holds the lease on its output from the start of its run
+        return self.state_db_factory().get_lease(stage.output) is not None
+
+    def is_stale(self, stage):
+        if self.is_running(stage):
+            # Its job checks again when it finishes
+            return False
+        state = self.state_db_factory().get_dataset_state(stage.output)
+        if state is None or state['inputs'] is None:
+            # Never (successfully) computed
+            return True
+        return json.loads(state['inputs']) != self.input_hashes(stage)
+
+    def downstream(self, dataset):
+        return [s for s in self.stages.values() if dataset in s.inputs or dataset in s.requires]
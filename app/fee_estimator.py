@@ -0,0 +1,37 @@
+from math import isnan
+
+from requests import RequestException
+
+from ttl_cache import PersistentTTLCache
+
+nan = float('nan')
+
+
+class FeeEstimator:
+    # Caches raw ETH-denominated fee estimates per key; callers convert them to USD
+    # with the current ETH price, so cached estimates stay valid as coin prices move.
+    # estimators maps each key to a function returning the fee in ETH (nan on failure).
+    # Estimators that fail (gateway down or returning errors) fall back to the last good value.
+    def __init__(self, cache_file, ttl_sec, estimators):
+        self.cache = PersistentTTLCache(cache_file, ttl_sec)
+        self.estimators = estimators
+
+    def estimate_eth(self, key):
+        fee = self.cache.get(key)
+        if fee is not None:
+            return fee
+        try:
+            fee = self.estimators[key]()
+        except (RequestException, KeyError, TypeError, ValueError, IndexError, StopIteration) as e:
+            print(f'Warning: fee estimator for {key} failed: {e!r}')
+            fee = nan
+        if fee is None or isnan(fee):
+            fee = self.cache.get(key, allow_stale=True)
+            if fee is None:
+                print(f'Warning: no fee estimate available for {key}')
+                return nan
+            print(f'Warning: serving stale fee estimate for {key} ({self.cache.age(key):.0f}s old)')
+            return fee
+        self.cache.set(key, fee)
+        self.cache.save()
+        return fee
@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+import pandas as pd
+
+
+def file_key(file):
+    # Identifies one version of a file; changes whenever the file is replaced or rewritten
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return (file, None, None)
+    return (file, st.st_mtime_ns, st.st_size)
+
+
+def frame_nbytes(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    # e.g. indexes over a frame
+    return int(getattr(value, 'nbytes', 0))
+
+
+class FrameCache:
+    # Process-wide cache of parsed and derived frames, shared by all Streamlit
+    # sessions. Entries are keyed on file identity so they go stale as soon as
+    # the underlying data changes; old or oversized entries are evicted (LRU).
+    # Cached frames are shared: callers must not modify them in place.
+    def __init__(self, max_age_sec=900, max_bytes=512 * 1024 ** 2):
+        self.max_age_sec = max_age_sec
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (created, nbytes, value)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[2]
+        value = build()
+        with self._lock:
+            if key not in self._entries:
+                nbytes = frame_nbytes(value)
+                self._entries[key] = (time(), nbytes, value)
+                self._nbytes += nbytes
+                self._evict()
+        return value
+
+    def load(self, file, load_func=pd.read_csv):
+        key = ('file', load_func, *file_key(file))
+        if key[-1] is None:
+            return None
+
+        def build():
+            df = load_func(file)
+            # Lets derived entries be keyed on exactly the version that was loaded
+            df.attrs['cache_key'] = key
+            return df
+        return self.get(key, build)
+
+    def _evict(self):
+        now = time()
+        for key in [k for k, (created, _, _) in self._entries.items() if now - created > self.max_age_sec]:
+            self._pop(key)
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+frame_cache = FrameCache()
@@ -0,0 +1,236 @@
+import os
+import json
+import random
+import threading
+from hashlib import sha1
+from glob import glob
+from time import time, sleep, perf_counter
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from metrics import http_request_seconds, http_responses, http_retries, http_backoff_seconds
+
+
+class HttpClient:
+    # Shared HTTP layer for all fetchers:
+    # - one keep-alive Session (connection pool) per host
+    # - default timeouts
+    # - retries with jittered exponential backoff (honouring Retry-After)
+    # - optional per-host governor (rate_limit.HostGovernor) throttling every attempt
+    # - optional on-disk cache for GETs revalidated with ETag/If-Modified-Since; entries
+    #   unused for cache_max_age_sec are evicted, then the least recently used ones
+    #   beyond cache_max_bytes
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, cache_dir=None, timeout=30, max_retries=5,
+                 backoff_base_sec=1, backoff_max_sec=60, pool_maxsize=16,
+                 cache_max_age_sec=7 * 86400, cache_max_bytes=512 * 1024 ** 2, cache_evict_interval_sec=600):
+        self.cache_dir = cache_dir
+        self.cache_max_age_sec = cache_max_age_sec
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_evict_interval_sec = cache_evict_interval_sec
+        self._last_evict = 0
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.pool_maxsize = pool_maxsize
+        self.governor = None
+        self._sessions = {}
+        self._parsed = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                s.mount('https://', adapter)
+                s.mount('http://', adapter)
+                self._sessions[host] = s
+            return self._sessions[host]
+
+    @staticmethod
+    def retry_after_sec(retry_after):
+        # Only the delay-seconds form of Retry-After is supported
+        return float(retry_after) if retry_after is not None and retry_after.isdigit() else None
+
+    def backoff_delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max_sec, self.backoff_base_sec * 2 ** attempt))
+        retry_after = self.retry_after_sec(retry_after)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def request(self, method, url, cache=False, max_retries=None, **kwargs):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        headers = dict(kwargs.pop('headers', None) or {})
+        kwargs.setdefault('timeout', self.timeout)
+        cache = cache and self.cache_dir is not None and method.upper() == 'GET'
+        cached_meta = self._load_meta(url) if cache else None
+        if cached_meta is not None:
+            if cached_meta.get('etag'):
+                headers['If-None-Match'] = cached_meta['etag']
+            if cached_meta.get('last_modified'):
+                headers['If-Modified-Since'] = cached_meta['last_modified']
+
+        session = self.session(url)
+        host = urlsplit(url).netloc
+        attempt = 0
+        while True:
+            retry_after = None
+            if self.governor is not None:
+                self.governor.acquire(host)
+            t = perf_counter()
+            r = None
+            error = None
+            try:
+                r = session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                # Released on any outcome, or the host's slot in the shared governor stays taken
+                if self.governor is not None:
+                    if r is None:
+                        self.governor.release(host)
+                    else:
+                        self.governor.release(host, r.status_code, self.retry_after_sec(r.headers.get('Retry-After')))
+            http_request_seconds.labels(host, method.upper()).observe(perf_counter() - t)
+            if error is not None:
+                http_responses.labels(host, 'error').inc()
+                if attempt >= max_retries:
+                    raise error
+                reason = repr(error)
+                http_retries.labels(host, type(error).__name__).inc()
+            else:
+                http_responses.labels(host, str(r.status_code)).inc()
+                if r.status_code == 304 and cached_meta is not None:
+                    return self._cached_response(url, cached_meta)
+                if r.status_code not in self.retry_statuses or attempt >= max_retries:
+                    break
+                reason = f'{r.status_code} {r.reason}'
+                retry_after = r.headers.get('Retry-After')
+                http_retries.labels(host, str(r.status_code)).inc()
+            delay = self.backoff_delay(attempt, retry_after)
+            http_backoff_seconds.labels(host).inc(delay)
+            print(f'HTTP {method} {url} failed ({reason}); retrying in {delay:.1f}s...')
+            sleep(delay)
+            attempt += 1
+
+        r.from_cache = False
+        if cache and r.status_code == 200:
+            self._store(url, r)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        # Revalidated responses that have not changed reuse the parsed body
+        r = self.get(url, **kwargs)
+        r.raise_for_status()
+        validator = (r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        key = self._cache_key(url)
+        if r.from_cache and any(validator):
+            with self._lock:
+                parsed = self._parsed.get(key)
+            if parsed is not None and parsed[0] == validator:
+                return parsed[1]
+        data = r.json()
+        if any(validator):
+            with self._lock:
+                self._parsed[key] = (validator, data)
+        return data
+
+    @staticmethod
+    def _cache_key(url):
+        return sha1(url.encode()).hexdigest()
+
+    def _cache_paths(self, url):
+        base = os.path.join(self.cache_dir, self._cache_key(url))
+        return base + '.json', base + '.body'
+
+    def _load_meta(self, url):
+        meta_file, body_file = self._cache_paths(url)
+        if not (os.path.isfile(meta_file) and os.path.isfile(body_file)):
+            return None
+        try:
+            with open(meta_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _store(self, url, r):
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            # Nothing to revalidate with
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        meta_file, body_file = self._cache_paths(url)
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(body_file + suffix, 'wb') as f:
+            f.write(r.content)
+        with open(meta_file + suffix, 'w') as f:
+            json.dump(dict(
+                url=url,
+                etag=etag,
+                last_modified=last_modified,
+                headers={k: v for k, v in r.headers.items() if k.lower() in ('content-type', 'etag', 'last-modified')}
+            ), f)
+        os.replace(body_file + suffix, body_file)
+        os.replace(meta_file + suffix, meta_file)
+        if time() - self._last_evict > self.cache_evict_interval_sec:
+            self._last_evict = time()
+            self.evict_cache()
+
+    def evict_cache(self):
+        # Body files' mtime is the last use (revalidation hits touch it)
+        entries = []
+        for body_file in glob(os.path.join(self.cache_dir, '*.body')):
+            try:
+                st = os.stat(body_file)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, body_file))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        now = time()
+        evicted = 0
+        for mtime, size, body_file in entries:
+            if now - mtime <= self.cache_max_age_sec and total_bytes <= self.cache_max_bytes:
+                break
+            for file in (body_file, body_file[:-len('.body')] + '.json'):
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+            evicted += 1
+        if evicted:
+            print(f'HTTP cache: evicted {evicted} entries')
+
+    def _cached_response(self, url, meta):
+        _, body_file = self._cache_paths(url)
+        with open(body_file, 'rb') as f:
+            content = f.read()
+        try:
+            os.utime(body_file)
+        except FileNotFoundError:
+            pass
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = 'OK (not modified)'
+        r.url = url
+        r.headers = CaseInsensitiveDict(meta.get('headers', {}))
+        r._content = content
+        r.encoding = 'utf-8'
+        r.from_cache = True
+        return r
@@ -0,0 +1,76 @@
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+
+# Metrics are recorded by the UI, the scheduler and its worker processes, so use
+# prometheus_client's multiprocess mode; this must be set before it is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join('data', 'metrics'))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+http_request_seconds = Histogram(
+    'spacesquid_http_request_seconds', 'Upstream HTTP request latency', ['host', 'method'])
+http_responses = Counter(
+    'spacesquid_http_responses_total', 'Upstream HTTP responses by status (error = no response)', ['host', 'status'])
+http_retries = Counter(
+    'spacesquid_http_retries_total', 'Upstream HTTP retries', ['host', 'reason'])
+http_backoff_seconds = Counter(
+    'spacesquid_http_backoff_seconds_total', 'Time spent backing off before retries', ['host'])
+assets_per_run = Histogram(
+    'spacesquid_assets_per_run', 'Assets priced per update_nft_prices run', ['collection', 'mode'],
+    buckets=(10, 50, 100, 500, 1000, 5000, 10000, 50000))
+stage_seconds = Histogram(
+    'spacesquid_stage_seconds', 'Time spent in each stage of background jobs', ['stage'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+ui_rerun_seconds = Histogram(
+    'spacesquid_ui_rerun_seconds', 'Streamlit script rerun duration',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+trace_spans = False
+_span_stack = threading.local()
+
+
+@contextmanager
+def span(name):
+    # Times a stage of a job into spacesquid_stage_seconds; with trace_spans on,
+    # also logs it with its parent stages, e.g. [span] update_nft_prices/pricing 3.2s
+    stack = getattr(_span_stack, 'names', None)
+    if stack is None:
+        stack = _span_stack.names = []
+    stack.append(name)
+    path = '/'.join(stack)
+    t = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - t
+        stack.pop()
+        stage_seconds.labels(path).observe(elapsed)
+        if trace_spans:
+            print(f'[span] {path} {elapsed:.3f}s')
+
+
+class SnapshotAgeCollector:
+    # Reads dataset ages from the freshness registry at scrape time
+    def __init__(self, state_db_factory):
+        self.state_db_factory = state_db_factory
+
+    def collect(self):
+        g = GaugeMetricFamily('spacesquid_snapshot_age_seconds', 'Age of the latest dataset snapshot', labels=['dataset'])
+        now = datetime.now()
+        for state in self.state_db_factory().list_dataset_states():
+            if state['last_update']:
+                g.add_metric([state['dataset']], (now - datetime.fromisoformat(state['last_update'])).total_seconds())
+        yield g
+
+
+def start_metrics_server(port, state_db_factory, addr='127.0.0.1'):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(SnapshotAgeCollector(state_db_factory))
+    start_http_server(port, addr=addr, registry=registry)
+    print(f'Metrics: serving on http://{addr}:{port}/metrics')
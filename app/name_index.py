@@ -0,0 +1,75 @@
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+def normalize_name(name):
+    return name.lower().strip()
+
+
+class NameIndex:
+    # Exact, prefix and substring lookups over a fixed list of names.
+    # Lookups return positions into the original list, in list order.
+    def __init__(self, names):
+        self.names = list(names)
+        self._exact = {}
+        prefixes = []
+        suffixes = []
+        for i, name in enumerate(self.names):
+            if not isinstance(name, str):
+                continue
+            self._exact.setdefault(name, []).append(i)
+            norm_name = normalize_name(name)
+            prefixes.append((norm_name, i))
+            # Every substring of a name is a prefix of one of its suffixes
+            suffixes.extend((norm_name[j:], i) for j in range(len(norm_name) + 1))
+        prefixes.sort()
+        suffixes.sort()
+        self._prefix_keys = [k for k, _ in prefixes]
+        self._prefix_pos = [i for _, i in prefixes]
+        self._suffix_keys = [k for k, _ in suffixes]
+        self._suffix_pos = [i for _, i in suffixes]
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def _scan(keys, positions, query):
+        start = bisect_left(keys, query)
+        end = start
+        while end < len(keys) and keys[end].startswith(query):
+            end += 1
+        return sorted(set(positions[start:end]))
+
+    def exact(self, name):
+        return list(self._exact.get(name, []))
+
+    def prefix(self, query):
+        return self._scan(self._prefix_keys, self._prefix_pos, normalize_name(query))
+
+    def substring(self, query):
+        return self._scan(self._suffix_keys, self._suffix_pos, normalize_name(query))
+
+    def has_substring(self, query):
+        query = normalize_name(query)
+        i = bisect_left(self._suffix_keys, query)
+        return i < len(self._suffix_keys) and self._suffix_keys[i].startswith(query)
+
+    def match(self, name):
+        # Exact match first; names don't always match up exactly between data
+        # sources so fall back to a case-insensitive prefix match
+        return self.exact(name) or self.prefix(name)
+
+
+_cached_indexes = OrderedDict()
+
+
+def get_name_index(key, names, max_entries=4):
+    # Build the index once per snapshot (identified by key) and share it
+    # between callers, e.g. every Streamlit session in the same process
+    index = _cached_indexes.get(key)
+    if index is None:
+        index = NameIndex(names)
+        _cached_indexes[key] = index
+        while len(_cached_indexes) > max_entries:
+            _cached_indexes.popitem(last=False)
+    return index
@@ -0,0 +1,127 @@
+import os
+import math
+import sqlite3
+import threading
+from datetime import datetime
+from time import time
+
+import numpy as np
+import pandas as pd
+
+# Rollup resolution -> bucket length in seconds
+resolutions = {'1m': 60, '1h': 3600, '1d': 86400}
+default_retention_days = {'1m': 1, '1h': 30, '1d': 730}
+spark_chars = '▁▂▃▄▅▆▇█'
+
+
+def sparkline(values):
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return ''
+    low, high = values[valid].min(), values[valid].max()
+    if high == low:
+        levels = np.full(len(values), len(spark_chars) // 2)
+    else:
+        levels = np.round((np.where(valid, values, low) - low) / (high - low) * (len(spark_chars) - 1)).astype(int)
+    return ''.join(spark_chars[level] if ok else ' ' for level, ok in zip(levels, valid))
+
+
+class PriceHistory:
+    # Per-token rollups of the published prices: OHLC of OS USD, lowest DTC and highest
+    # Arb per time bucket, at each resolution:
+    #   price_rollup(collection, resolution, token_id, bucket) -> values
+    # Every snapshot is folded into the current bucket of all resolutions, so charts read
+    # a few rows per token and never the raw snapshots. Fine resolutions are kept for a
+    # shorter time than coarse ones, which bounds the size of the history.
+    table_name = 'price_rollup'
+    columns = ['bucket', 'usd_open', 'usd_high', 'usd_low', 'usd_close', 'dtc_min', 'arb_max', 'samples']
+
+    def __init__(self, filename, retention_days={}):
+        self.filename = filename
+        self.retention_days = {**default_retention_days, **retention_days}
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # One connection per thread (Streamlit sessions run in threads)
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table_name}('
+                'collection TEXT, resolution TEXT, token_id TEXT, bucket INTEGER, '
+                'usd_open REAL, usd_high REAL, usd_low REAL, usd_close REAL, dtc_min REAL, arb_max REAL, '
+                'samples INTEGER, PRIMARY KEY (collection, resolution, token_id, bucket)) WITHOUT ROWID')
+            # For retention
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table_name}_bucket ON {self.table_name}(collection, resolution, bucket)')
+            conn.commit()
+            self._local.connection = conn
+        return conn
+
+    def add(self, collection, prices, t=None):
+        # Folds one snapshot (token_id, OS USD, DTC, Arb) into the current buckets
+        t = t or time()
+
+        def column(name):
+            return prices[name].values.astype(float) if name in prices.columns else np.full(len(prices), np.nan)
+        usd, dtc, arb = column('OS USD'), column('DTC'), column('Arb')
+        rows = [
+            (str(token_id), *(None if math.isnan(v) else float(v) for v in (u, d, a)))
+            for token_id, u, d, a in zip(prices.token_id.values, usd, dtc, arb)
+            if not (math.isnan(u) and math.isnan(d) and math.isnan(a))]
+        with self.connection as conn:
+            for resolution, bucket_sec in resolutions.items():
+                bucket = int(t // bucket_sec * bucket_sec)
+                # NULL (no listing, no reward) never replaces a value
+                conn.executemany(
+                    f'INSERT INTO {self.table_name} (collection, resolution, token_id, bucket, '
+                    'usd_open, usd_high, usd_low, usd_close, dtc_min, arb_max, samples) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1) '
+                    'ON CONFLICT(collection, resolution, token_id, bucket) DO UPDATE SET '
+                    'usd_open = coalesce(usd_open, excluded.usd_open), '
+                    'usd_high = max(coalesce(usd_high, excluded.usd_high), coalesce(excluded.usd_high, usd_high)), '
+                    'usd_low = min(coalesce(usd_low, excluded.usd_low), coalesce(excluded.usd_low, usd_low)), '
+                    'usd_close = coalesce(excluded.usd_close, usd_close), '
+                    'dtc_min = min(coalesce(dtc_min, excluded.dtc_min), coalesce(excluded.dtc_min, dtc_min)), '
+                    'arb_max = max(coalesce(arb_max, excluded.arb_max), coalesce(excluded.arb_max, arb_max)), '
+                    'samples = samples + 1',
+                    [(collection, resolution, token_id, bucket, u, u, u, u, d, a) for token_id, u, d, a in rows])
+                conn.execute(
+                    f'DELETE FROM {self.table_name} WHERE collection = ? AND resolution = ? AND bucket < ?',
+                    (collection, resolution, bucket - self.retention_days[resolution] * 86400))
+        return len(rows)
+
+    def history(self, collection, token_id, resolution='1h', start=None):
+        # Buckets of one token, oldest first, with their start as a `time` column
+        df = pd.read_sql_query(
+            f'SELECT {", ".join(self.columns)} FROM {self.table_name} '
+            'WHERE collection = ? AND resolution = ? AND token_id = ? AND bucket >= ? ORDER BY bucket',
+            self.connection, params=(collection, resolution, str(token_id), int(start or 0)))
+        # Columns without any value come back as None
+        value_columns = self.columns[1:-1]
+        df[value_columns] = df[value_columns].astype(float)
+        df['time'] = [datetime.fromtimestamp(b) for b in df.bucket]
+        return df
+
+    def sparklines(self, collection, token_ids, resolution='1h', points=24, t=None):
+        # token_id -> sparkline of the closing OS USD over the last `points` buckets. Buckets
+        # without a snapshot (nothing changed) carry the previous close forward.
+        bucket_sec = resolutions[resolution]
+        first = int((t or time()) // bucket_sec * bucket_sec) - (points - 1) * bucket_sec
+        token_ids = [str(token_id) for token_id in token_ids]
+        closes = {token_id: np.full(points, np.nan) for token_id in token_ids}
+        # Stays below SQLite's limit on query parameters
+        for i in range(0, len(token_ids), 500):
+            chunk = token_ids[i:i + 500]
+            for token_id, bucket, close in self.connection.execute(
+                    f'SELECT token_id, bucket, usd_close FROM {self.table_name} '
+                    'WHERE collection = ? AND resolution = ? AND bucket >= ? AND bucket < ? '
+                    f'AND token_id IN ({", ".join("?" * len(chunk))})',
+                    (collection, resolution, first, first + points * bucket_sec, *chunk)):
+                if close is not None:
+                    closes[token_id][(bucket - first) // bucket_sec] = close
+        return {token_id: sparkline(pd.Series(values).ffill().values) for token_id, values in closes.items()}
@@ -0,0 +1,90 @@
+from collections import defaultdict
+
+import numpy as np
+
+ngram_size = 3
+
+
+def normalize_name(name):
+    return str(name).lower().strip()
+
+
+def ngrams(text):
+    return {text[i:i + ngram_size] for i in range(len(text) - ngram_size + 1)}
+
+
+class PriceIndex:
+    # Built once per price snapshot: a sort permutation per sortable column (NaN last)
+    # and an n-gram index over normalized names. Queries filter with range lookups on
+    # the presorted columns and return one page of rows.
+    def __init__(self, prices, sort_columns):
+        self.prices = prices
+        self.n = len(prices)
+        self.perms = {}
+        self.sorted_values = {}
+        self.valid_counts = {}
+        for col in dict.fromkeys(sort_columns):
+            if col not in prices.columns:
+                continue
+            values = prices[col].values.astype(float)
+            perm = np.argsort(values, kind='stable')
+            self.perms[col] = perm
+            self.sorted_values[col] = values[perm]
+            self.valid_counts[col] = int((~np.isnan(values)).sum())
+        self.names = [normalize_name(name) for name in prices['Name'].values]
+        postings = defaultdict(list)
+        for i, name in enumerate(self.names):
+            for gram in ngrams(name):
+                postings[gram].append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()}
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.perms.values()) * 2 + sum(a.nbytes for a in self.postings.values())
+
+    def range_mask(self, col, low=None, high=None, include_low=True, include_high=True):
+        # Rows with low <= col <= high (bounds optional), found by binary search on the sorted column
+        values = self.sorted_values[col][:self.valid_counts[col]]
+        start = 0 if low is None else np.searchsorted(values, low, 'left' if include_low else 'right')
+        end = len(values) if high is None else np.searchsorted(values, high, 'right' if include_high else 'left')
+        mask = np.zeros(self.n, dtype=bool)
+        mask[self.perms[col][start:end]] = True
+        return mask
+
+    def search_mask(self, text):
+        # Rows whose normalized name contains text
+        text = normalize_name(text)
+        mask = np.zeros(self.n, dtype=bool)
+        grams = ngrams(text)
+        if grams:
+            candidates = None
+            for gram in grams:
+                ids = self.postings.get(gram)
+                if ids is None:
+                    return mask
+                candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique=True)
+        else:
+            # Shorter than an n-gram: scan the names
+            candidates = range(self.n)
+        mask[[i for i in candidates if text in self.names[i]]] = True
+        return mask
+
+    def order(self, col, ascending=True):
+        perm = self.perms[col]
+        if ascending:
+            return perm
+        valid = self.valid_counts[col]
+        return np.concatenate([perm[:valid][::-1], perm[valid:]])
+
+    def query(self, sort_col, ascending=True, max_eth=None, arb_only=False, search_text='', page=0, page_size=100):
+        # Returns (rows of the requested page in order, number of matching rows)
+        mask = np.ones(self.n, dtype=bool)
+        if max_eth is not None:
+            mask &= self.range_mask('OS ETH', high=max_eth)
+        if arb_only:
+            mask &= self.range_mask('Arb', low=0, include_low=False)
+        if search_text:
+            mask &= self.search_mask(search_text)
+        order = self.order(sort_col, ascending)
+        matches = order[mask[order]]
+        return self.prices.iloc[matches[page * page_size:(page + 1) * page_size]], len(matches)
@@ -0,0 +1,69 @@
+import os
+import threading
+from glob import glob
+from time import time_ns
+
+import pyarrow as pa
+
+from snapshot_store import to_arrow_table
+
+
+class PublishedSnapshots:
+    # Immutable, versioned datasets ready for display:
+    #   <root>/<dataset>/<version>.arrow  (uncompressed Arrow IPC, memory-mappable)
+    #   <root>/<dataset>/LATEST           (latest version)
+    # Background jobs publish; viewer processes map each version once and share
+    # the frame between all their sessions, re-mapping only when LATEST changes.
+    def __init__(self, root, keep_versions=5):
+        self.root = root
+        self.keep_versions = keep_versions
+        self._mapped = {}  # dataset -> (version, frame)
+        self._lock = threading.Lock()
+
+    def _dir(self, dataset):
+        return os.path.join(self.root, dataset)
+
+    def latest_version(self, dataset):
+        try:
+            with open(os.path.join(self._dir(dataset), 'LATEST'), 'r') as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def publish(self, df, dataset):
+        dataset_dir = self._dir(dataset)
+        os.makedirs(dataset_dir, exist_ok=True)
+        version = time_ns()
+        table = to_arrow_table(df)
+        version_file = os.path.join(dataset_dir, f'{version}.arrow')
+        tmp_file = f'{version_file}.{os.getpid()}.tmp'
+        with pa.OSFile(tmp_file, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_file, version_file)
+        # Jobs publishing the same dataset concurrently: LATEST only moves forward
+        if version > (self.latest_version(dataset) or 0):
+            latest_tmp = os.path.join(dataset_dir, f'LATEST.{os.getpid()}.tmp')
+            with open(latest_tmp, 'w') as f:
+                f.write(str(version))
+            os.replace(latest_tmp, os.path.join(dataset_dir, 'LATEST'))
+        # Viewers keep already mapped versions readable after they are unlinked
+        for old_file in sorted(glob(os.path.join(dataset_dir, '*.arrow')))[:-self.keep_versions]:
+            os.remove(old_file)
+        return version
+
+    def latest(self, dataset):
+        # Latest version as a shared, read-only frame (attrs['cache_key'] identifies the version), or None
+        version = self.latest_version(dataset)
+        if version is None:
+            return None
+        with self._lock:
+            mapped = self._mapped.get(dataset)
+            if mapped is not None and mapped[0] == version:
+                return mapped[1]
+        source = pa.memory_map(os.path.join(self._dir(dataset), f'{version}.arrow'))
+        df = pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+        df.attrs['cache_key'] = ('published', dataset, version)
+        with self._lock:
+            self._mapped[dataset] = (version, df)
+        return df
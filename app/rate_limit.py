@@ -0,0 +1,89 @@
+import multiprocessing
+from time import time, sleep
+
+# Per-host limits; config.json 'rate_limits' overrides them per host, e.g.
+#   "rate_limits": {"api.opensea.io": {"rate": 4, "burst": 8, "max_concurrency": 4}}
+# rate: requests per second, burst: token bucket size, max_concurrency: requests in flight.
+# A plain number is read as the minimum interval between requests in seconds.
+default_host_limits = {
+    'api.opensea.io': dict(rate=4, burst=4, max_concurrency=4),
+    'walletsrv.gala.games': dict(rate=10, burst=10, max_concurrency=8),
+    'api.coingecko.com': dict(rate=1, burst=1, max_concurrency=1),
+    'nftlookup.io': dict(rate=1, burst=1, max_concurrency=1),
+}
+
+
+def host_limits(config_limits):
+    limits = {h: dict(v) for h, v in default_host_limits.items()}
+    for host, v in config_limits.items():
+        if not isinstance(v, dict):
+            v = dict(rate=1 / v, burst=1)
+        limits.setdefault(host, {}).update(v)
+    return limits
+
+
+class HostGovernor:
+    # Shared throttle for all requests to each host:
+    # - a token bucket caps the request rate (with bursts)
+    # - the rate and the number of requests in flight adapt AIMD-style: halved on
+    #   429/5xx/connection errors (at most once per second), grown back on successes
+    # - Retry-After pauses the host for every caller
+    # State lives in shared memory so all worker processes created with it share it.
+    fields = ['tokens', 'refill_time', 'rate', 'concurrency', 'in_flight', 'blocked_until', 'decrease_time']
+    throttle_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, limits, ctx=multiprocessing):
+        self.hosts = list(limits)
+        self.max_rate = [float(limits[h].get('rate', 1)) for h in self.hosts]
+        self.min_rate = [float(limits[h].get('min_rate', r / 16)) for h, r in zip(self.hosts, self.max_rate)]
+        self.burst = [float(limits[h].get('burst', 1)) for h in self.hosts]
+        self.max_concurrency = [int(limits[h].get('max_concurrency', 1)) for h in self.hosts]
+        self._state = ctx.Array('d', len(self.hosts) * len(self.fields))
+        for i in range(len(self.hosts)):
+            self._set(i, tokens=self.burst[i], rate=self.max_rate[i], concurrency=self.max_concurrency[i])
+
+    def _get(self, i, field):
+        return self._state[i * len(self.fields) + self.fields.index(field)]
+
+    def _set(self, i, **values):
+        for field, v in values.items():
+            self._state[i * len(self.fields) + self.fields.index(field)] = v
+
+    def acquire(self, host):
+        # Blocks until a request to host may start; pair with release()
+        if host not in self.hosts:
+            return
+        i = self.hosts.index(host)
+        while True:
+            with self._state.get_lock():
+                now = time()
+                rate = self._get(i, 'rate')
+                tokens = min(self.burst[i], self._get(i, 'tokens') + (now - self._get(i, 'refill_time')) * rate)
+                self._set(i, tokens=tokens, refill_time=now)
+                blocked_until = self._get(i, 'blocked_until')
+                in_flight = self._get(i, 'in_flight')
+                if now >= blocked_until and tokens >= 1 and in_flight < int(self._get(i, 'concurrency')):
+                    self._set(i, tokens=tokens - 1, in_flight=in_flight + 1)
+                    return
+                delay = max(blocked_until - now, (1 - tokens) / rate, 0.05)
+            sleep(delay)
+
+    def release(self, host, status=None, retry_after=None):
+        # status is None if the request failed without a response
+        if host not in self.hosts:
+            return
+        i = self.hosts.index(host)
+        with self._state.get_lock():
+            now = time()
+            self._set(i, in_flight=max(self._get(i, 'in_flight') - 1, 0))
+            rate = self._get(i, 'rate')
+            concurrency = self._get(i, 'concurrency')
+            if status is None or status in self.throttle_statuses:
+                if now - self._get(i, 'decrease_time') > 1:
+                    self._set(i, rate=max(self.min_rate[i], rate / 2), concurrency=max(1, concurrency / 2),
+                              decrease_time=now)
+                if retry_after:
+                    self._set(i, blocked_until=max(self._get(i, 'blocked_until'), now + retry_after))
+            else:
+                self._set(i, rate=min(self.max_rate[i], rate + self.max_rate[i] / 20),
+                          concurrency=min(self.max_concurrency[i], concurrency + 1 / concurrency))
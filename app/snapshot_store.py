@@ -0,0 +1,151 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+from glob import glob
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+snapshot_time_format = '%Y%m%dT%H%M%S%f'
+
+
+def to_arrow_table(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed-type object columns (e.g. scraped tables): store them as strings
+        df = df.copy()
+        for c in df.columns[df.dtypes == object]:
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+class SnapshotStore:
+    # Append-only history of one dataset:
+    #   <root>/<dataset>/date=YYYY-MM-DD/<snapshot time>.parquet
+    #   <root>/<dataset>/LATEST  (path of the newest snapshot, relative to the dataset dir)
+    # Each snapshot is one Parquet file sorted by index_col, written to a temp
+    # file and renamed into place so readers never see partial snapshots.
+    # Retention: days older than full_days keep one snapshot per hour, days older
+    # than retention_days are deleted (None keeps everything).
+    def __init__(self, root, dataset, index_col='token_id', full_days=2, retention_days=30):
+        self.root = root
+        self.dataset = dataset
+        self.index_col = index_col
+        self.full_days = full_days
+        self.retention_days = retention_days
+        self.dir = os.path.join(root, dataset)
+
+    def _snapshot_file(self, snapshot_time):
+        return os.path.join(
+            self.dir,
+            f'date={snapshot_time.strftime("%Y-%m-%d")}',
+            f'{snapshot_time.strftime(snapshot_time_format)}.parquet')
+
+    @staticmethod
+    def _snapshot_time(file):
+        return datetime.strptime(os.path.basename(file)[:-len('.parquet')], snapshot_time_format)
+
+    def _partitions(self, start=None, end=None):
+        # (date, dir) of the date= partitions overlapping [start, end], oldest first
+        partitions = []
+        for partition_dir in sorted(glob(os.path.join(self.dir, 'date=*'))):
+            d = datetime.strptime(os.path.basename(partition_dir)[len('date='):], '%Y-%m-%d').date()
+            if (start is None or d >= start.date()) and (end is None or d <= end.date()):
+                partitions.append((d, partition_dir))
+        return partitions
+
+    def append(self, df, snapshot_time=None):
+        snapshot_time = snapshot_time or datetime.now()
+        df = df.copy()
+        if self.index_col in df.columns:
+            df[self.index_col] = df[self.index_col].astype(str)
+            df = df.sort_values(self.index_col, kind='stable')
+        file = self._snapshot_file(snapshot_time)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = f'{file}.{os.getpid()}.tmp'
+        # Small row groups keep per-token reads selective via row group statistics
+        pq.write_table(to_arrow_table(df), tmp_file, row_group_size=1024)
+        os.replace(tmp_file, file)
+        latest_file = self._latest_file()
+        if latest_file is None or self._snapshot_time(latest_file) < snapshot_time:
+            latest_tmp = os.path.join(self.dir, f'LATEST.{os.getpid()}.tmp')
+            with open(latest_tmp, 'w') as f:
+                f.write(os.path.relpath(file, self.dir))
+            os.replace(latest_tmp, os.path.join(self.dir, 'LATEST'))
+        self.compact(snapshot_time)
+        return snapshot_time
+
+    def compact(self, now=None):
+        # Applies the retention policy to whole days; each day is only downsampled once
+        now = now or datetime.now()
+        for d, partition_dir in self._partitions(end=now - timedelta(days=self.full_days + 1)):
+            if self.retention_days is not None and d < (now - timedelta(days=self.retention_days)).date():
+                shutil.rmtree(partition_dir, ignore_errors=True)
+                continue
+            marker = os.path.join(partition_dir, '.compacted')
+            if os.path.isfile(marker):
+                continue
+            # Last snapshot of each hour
+            kept = {}
+            for file in sorted(glob(os.path.join(partition_dir, '*.parquet'))):
+                kept[self._snapshot_time(file).replace(minute=0, second=0, microsecond=0)] = file
+            kept = set(kept.values())
+            for file in glob(os.path.join(partition_dir, '*.parquet')):
+                if file not in kept:
+                    os.remove(file)
+            open(marker, 'w').close()
+
+    def _latest_file(self):
+        try:
+            with open(os.path.join(self.dir, 'LATEST'), 'r') as f:
+                file = os.path.join(self.dir, f.read().strip())
+        except FileNotFoundError:
+            return None
+        return file if os.path.isfile(file) else None
+
+    def list_snapshots(self, start=None, end=None):
+        snapshots = []
+        for _, partition_dir in self._partitions(start, end):
+            for file in sorted(glob(os.path.join(partition_dir, '*.parquet'))):
+                t = self._snapshot_time(file)
+                if (start is None or t >= start) and (end is None or t <= end):
+                    snapshots.append((t, file))
+        return snapshots
+
+    def _read(self, file, **kwargs):
+        return pq.read_table(file, **kwargs).to_pandas()
+
+    def latest(self):
+        file = self._latest_file()
+        if file is None:
+            # Store from before the LATEST pointer
+            return self.at(datetime.max)
+        return self._read(file)
+
+    def at(self, t):
+        # Last snapshot taken at or before t; only the newest partitions up to t are listed
+        for _, partition_dir in reversed(self._partitions(end=t)):
+            snapshots = [file for file in sorted(glob(os.path.join(partition_dir, '*.parquet')))
+                         if self._snapshot_time(file) <= t]
+            if snapshots:
+                return self._read(snapshots[-1])
+        return None
+
+    def snapshot_times(self):
+        return [t for t, _ in self.list_snapshots()]
+
+    def history(self, key, start=None, end=None, columns=None):
+        # All rows for one index_col value, oldest first, with a SnapshotTime column.
+        # Only opens the snapshots in [start, end]; retention bounds how many those are.
+        frames = []
+        for t, file in self.list_snapshots(start=start, end=end):
+            df = self._read(file, columns=columns and [self.index_col, *columns],
+                            filters=[(self.index_col, '==', str(key))])
+            if len(df) > 0:
+                df['SnapshotTime'] = t
+                frames.append(df)
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
@@ -1,27 +1,34 @@
 import os
-from datetime import datetime, timedelta
-import base64
+from datetime import datetime
+import uuid
 import subprocess
+from time import perf_counter
 
+import numpy as np
 import pandas as pd
+import altair as alt
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
 
 from util import *
 from background_state import BackgroundStateDB
+from frame_cache import frame_cache
+from table_renderer import table_renderer
+from alert_engine import alert_engine, alert_audio_html
+from price_query import PriceIndex
+from price_history import resolutions
+from metrics import ui_rerun_seconds
+
+rerun_start = perf_counter()
 
 st.set_page_config(page_title='SpaceSquid', layout='wide')
 
 page_refresh_interval = 30  # seconds
 refresh_count = st_autorefresh(interval=page_refresh_interval * 1000)
-page_last_refresh_time = datetime.now()
 
 print(f'refresh_count={refresh_count}')
 
-base_data_dir = 'data/town-star'
-nft_prices_csv = os.path.join(base_data_dir, 'nft_prices.csv')
-nft_rewards_csv = os.path.join(base_data_dir, 'nft_rewards.csv')
-coin_prices_csv = os.path.join(base_data_dir, 'coin_prices.csv')
+coin_prices_csv = default_coin_prices_csv
 
 st.markdown(
     f'''
@@ -48,22 +55,41 @@ with st.sidebar:
     def update_status(s):
         status_text.write('## Status: ' + s)
 
-def load_data(file, bg_args=[], load_func=pd.read_csv, force_update=False, patient=False):
-    if force_update or not os.path.isfile(file):
-        subprocess.Popen(['python', 'app/background_updater.py', *bg_args], start_new_session=True)
-        bsdb = BackgroundStateDB()
-        bg_jobs = [row[0] for row in bsdb.list_processes()]
+def request_update(file, bg_args=[], force_update=False):
+    bsdb = BackgroundStateDB()
+    lease = bsdb.get_lease(file)
+    if lease is not None:
+        update_status(f'Waiting for background job: {lease["job"]}')
+    elif force_update or not os.path.isfile(file):
+        if bsdb.get_lease('scheduler') is not None:
+            # Scheduler daemon merges duplicate requests from all sessions into one run
+            bsdb.request_refresh(bg_args[0], bg_args[1:])
+        else:
+            subprocess.Popen(['python', 'app/background_updater.py', *bg_args], start_new_session=True)
+        bg_jobs = [lease['job'] if lease['job'] == lease['name'] else f'{lease["job"]}({lease["name"]})'
+                   for lease in bsdb.list_leases()]
         update_status(f'Running background jobs: {",".join(bg_jobs)}')
-    return load_file(file, load_func, patient=patient)
 
-rewards_expired = has_expired(nft_rewards_csv, 3600)
-rewards = load_data(nft_rewards_csv, bg_args=['update_nft_rewards', nft_rewards_csv], force_update=rewards_expired, patient=True)
+def load_published(view, file, bg_args=[], force_update=False):
+    # Published view mapped once per process and shared by all sessions; None if not published yet
+    request_update(file, bg_args, force_update=force_update)
+    return published_snapshots.latest(view)
 
-coin_prices_expired = True
-coin_prices = load_data(coin_prices_csv, bg_args=['update_coin_prices', coin_prices_csv, 'ethereum', 'gala', 'town-star'], force_update=coin_prices_expired, patient=True)
+coin_prices_expired = has_expired(coin_prices_csv, page_refresh_interval)
+coin_prices_args = ['update_coin_prices', coin_prices_csv, *tracked_coins]
+coin_prices = load_published(coin_prices_view, coin_prices_csv, bg_args=coin_prices_args, force_update=coin_prices_expired)
+if coin_prices is None:
+    coin_prices = load_file(coin_prices_csv, frame_cache.load)
+if coin_prices is None:
+    # First run: everything is priced in coins, so there is nothing to show until they arrive
+    update_status('Waiting for coin prices...')
+    st.stop()
+coin_prices_key = coin_prices.attrs['cache_key']
 coin_prices = coin_prices.set_index('coin')
 
 with st.sidebar:
+    selected_collections = st.multiselect(
+        'Collections', options=list(tracked_collections), default=list(tracked_collections)[:1])
     item_count_text = st.empty()
 
     for line in [
@@ -76,6 +102,22 @@ with st.sidebar:
         ]:
         st.markdown(line)
 
+    def format_age(age):
+        if age is None:
+            return 'N/A'
+        sec = age.total_seconds()
+        return f'{sec:.0f}s' if sec < 120 else f'{sec / 60:.0f}m' if sec < 7200 else f'{sec / 3600:.0f}h'
+
+    st.markdown('\n'.join([
+        '| Collection | Rewards age | NFT prices age |',
+        '| --- | --- | --- |',
+        *(f'| {name} '
+          f'| {format_age(get_data_age(tracked_collections[name].nft_rewards_csv)) if tracked_collections[name].reward_source else "-"} '
+          f'| {format_age(get_data_age(tracked_collections[name].nft_prices_csv))} |'
+          for name in selected_collections),
+        f'\nCoin prices age: {format_age(get_data_age(coin_prices_csv))}',
+    ]))
+
     st.write('\n')
     update_status('Idle')
 
@@ -98,26 +140,45 @@ with st.sidebar:
     with cols[1]:
         sort_order = st.selectbox(label='Order', options=['ASC', 'DESC'])
 
-nft_prices_expired = update_token_id_btn or has_expired(nft_prices_csv, 60)
-prices = load_data(nft_prices_csv, bg_args=['update_nft_prices', nft_prices_csv, nft_rewards_csv, coin_prices_csv, '1' if update_token_id_btn else ''], force_update=nft_prices_expired)
+def load_collection_prices(c):
+    # Returns (cache key, prices with Reward/DTC) for one collection, or (None, None) if no data yet
+    if c.reward_source:
+        rewards_expired = has_expired(c.nft_rewards_csv, c.rewards_refresh_interval)
+        request_update(c.nft_rewards_csv, bg_args=['update_nft_rewards', c.nft_rewards_csv, c.name], force_update=rewards_expired)
+    nft_prices_expired = update_token_id_btn or has_expired(c.nft_prices_csv, c.refresh_interval)
+    prices = load_published(c.prices_view, c.nft_prices_csv, bg_args=['update_nft_prices', c.nft_prices_csv, c.nft_rewards_csv, coin_prices_csv, '1' if update_token_id_btn else '', '' if update_token_id_btn else '1', c.name], force_update=nft_prices_expired)
+    if prices is not None:
+        return prices.attrs['cache_key'], prices
+
+    # Not published yet (older data): derive it here
+    rewards = load_file(c.nft_rewards_csv, frame_cache.load) if c.reward_source else None
+    prices = load_file(c.nft_prices_csv, frame_cache.load)
+    if prices is None:
+        return None, None
+    # Cached per version of the input files; shared by all sessions
+    prices_key = ('prices_with_rewards', c.name, prices.attrs['cache_key'], rewards is not None and rewards.attrs['cache_key'], coin_prices_key)
+    reward_usd = coin_prices.loc[c.reward_coin].usd if c.reward_coin in coin_prices.index else float('nan')
+    return prices_key, frame_cache.get(prices_key, lambda: add_reward_columns(
+        reprice_nft_prices(prices, coin_prices.reset_index()), rewards, reward_usd))
+
+collection_prices = {}
+for name in selected_collections:
+    c_key, c_prices = load_collection_prices(tracked_collections[name])
+    if c_prices is not None:
+        collection_prices[name] = (c_key, c_prices)
+
+prices = None
+if len(collection_prices) == 1:
+    prices_key, prices = next(iter(collection_prices.values()))
+elif len(collection_prices) > 1:
+    # Combined view; only rebuilt when one of the collections changes
+    prices_key = ('combined', *(k for k, _ in collection_prices.values()))
+    prices = frame_cache.get(prices_key, lambda: pd.concat(
+        [p.assign(Collection=name) for name, (_, p) in collection_prices.items()], ignore_index=True))
 
 if prices is not None:
-    def get_reward(name):
-        name_match = (rewards.name == name)
-        if not any(name_match):
-            # Sometimes names don't match up exactly between data sources
-            name_match = (lowertrim(rewards.name).str.startswith(lowertrim(name)))
-        if not any(name_match):
-            print(f'Warning: Reward info unavailable for {name}')
-            return float('nan')
-        r = rewards[name_match]
-        n = len(r)
-        if n > 1:
-            print(f'Warning: {name} has {n} reward matches: {r}')
-        return float(r.reward.iloc[0])
-
-    prices['Reward'] = prices.Name.map(get_reward)
-    prices['DTC'] = prices['OS USD'] / (prices.Reward * coin_prices.loc['town-star'].usd)
+    # No-op unless this is a new snapshot
+    alert_engine.on_snapshot(prices_key, prices)
 
     item_count_text.write(f'Total: {len(prices)} items')
 
@@ -125,87 +186,119 @@ with st.sidebar:
     arb_only = st.checkbox('Arb Only', value=False)
     max_eth = st.slider('Max ETH', min_value=0.1, max_value=10.0, value=1.0, step=0.01)
     dtc_warn_threshold = st.slider('DTC Alert Threshold', step=1, min_value=1, max_value=200, value=130)
+    arb_warn_threshold = st.number_input('Arb Alert Threshold ($, 0 = off)', min_value=0, value=0, step=10)
+
+if 'alert_session_id' not in st.session_state:
+    st.session_state.alert_session_id = uuid.uuid4().hex
+alert_engine.subscribe(
+    st.session_state.alert_session_id,
+    prices_key if prices is not None else None,
+    dtc_below=dtc_warn_threshold,
+    arb_above=arb_warn_threshold or None,
+    max_eth=max_eth,
+    arb_only=arb_only)
+
+cols = st.columns([0.8, 0.2])
+with cols[0]:
+    search_text = st.text_input(label='Search Item: ', value='')
+with cols[1]:
+    page = st.number_input('Page', min_value=1, value=1, step=1)
+page_size = config.get('page_size', 100)
+# Trend column: closing OS USD per hour over the last day
+sparkline_resolution = config.get('sparkline_resolution', '1h')
+sparkline_points = config.get('sparkline_points', 24)
+history_chart_window_sec = {'1m': 6 * 3600, '1h': 7 * 86400, '1d': 365 * 86400}
 
-# Generate markdown table
-md_exclude_headers =  ['token_id', 'LastUpdate', 'OS Link', 'OS Qty', 'GS Link', 'GS Qty']
-def generate_md_row(row):
-    str_vals = []
-    os_qty = f'{max(row["OS Qty"], 0):.0f}'
-    if os_qty in ['0', 'nan']:
-        os_qty = '⚠️'
-    gs_qty = f'{max(row["GS Qty"], 0):.0f}'
-    if gs_qty in ['0', 'nan']:
-        gs_qty = '⚠️'
-    for idx, val in zip(row.index, row.values):
-        if idx in md_exclude_headers:
-            continue
-        str_vals.append(str({
-            'OS ETH': lambda v: f'{float(v):.4f}',
-            'OS USD': lambda v: f'${v:,.0f}',
-            'OS LastSale USD': lambda v: f'${v:,.0f}',
-            'GS USD': lambda v: f'${v:,.0f}',
-            'OS Change': lambda v: f'{v:,.1f}%',
-            'Reward': lambda v: f'{v:.0f} (${v * coin_prices.loc["town-star"].usd:.1f})',
-            'DTC': lambda v: f'{v:.1f}',
-            'Arb': lambda v: f'${v:,.0f}',
-            'Name': lambda v: f'{v}<br/>([OS:{os_qty}]({row["OS Link"]}), [GS:{gs_qty}]({row["GS Link"]}))'
-        }.get(idx, lambda v: v)(val)))
-    return ('|' + '|'.join(str_vals) + '|')
-
-
-def generate_md_header(cols):
-    cols = [c for c in cols if c not in md_exclude_headers]
-    return [
-        ('|' + '|'.join(cols) + '|'),
-        ('|' + '|'.join('---' for _ in cols) + '|')
-    ]
-
-search_text = st.text_input(label='Search Item: ', value='')
+def row_collections(rows):
+    if 'Collection' in rows.columns:
+        return rows['Collection'].values
+    return np.full(len(rows), next(iter(collection_prices)), dtype=object)
+
+def add_trend_column(rows):
+    # Sparklines come from the rollups; one indexed query per collection on the page
+    collections = row_collections(rows)
+    token_ids = rows.token_id.astype(str).values
+    trend = np.full(len(rows), '', dtype=object)
+    for name in set(collections):
+        in_collection = collections == name
+        lines = price_history.sparklines(
+            name, token_ids[in_collection], resolution=sparkline_resolution, points=sparkline_points)
+        trend[in_collection] = [lines[token_id] for token_id in token_ids[in_collection]]
+    rows = rows.copy()
+    rows.insert(rows.columns.get_loc('Name') + 1, 'Trend', trend)
+    return rows
+
+def history_chart(history, title):
+    base = alt.Chart(history).encode(x=alt.X('time:T', title=None))
+    usd_range = base.mark_area(opacity=0.3).encode(y=alt.Y('usd_low:Q', title='OS USD'), y2='usd_high:Q')
+    usd_close = base.mark_line(point=True).encode(
+        y='usd_close:Q', tooltip=['time:T', 'usd_open:Q', 'usd_high:Q', 'usd_low:Q', 'usd_close:Q', 'samples:Q'])
+    dtc = base.mark_line(color='orange').encode(y=alt.Y('dtc_min:Q', title='Min DTC'), tooltip=['time:T', 'dtc_min:Q'])
+    arb = base.mark_line(color='green').encode(y=alt.Y('arb_max:Q', title='Max Arb'), tooltip=['time:T', 'arb_max:Q'])
+    return alt.vconcat(
+        (usd_range + usd_close).properties(title=title, height=220),
+        dtc.properties(height=120),
+        arb.properties(height=120))
 
 last_price_update_time = 'Never'
 table_md = ''
+page_text = ''
 if prices is not None:
-    # Filter and sort prices
-    last_price_update_time = datetime.fromisoformat(prices.LastUpdate.iloc[0]).strftime("%Y-%m-%d %H:%M")
-    if arb_only:
-        prices = prices[prices['Arb'] > 0]
-
-    prices = prices[prices['OS ETH'] <= max_eth]\
-        .sort_values(price_sort_map.get(sort_option, sort_option),
-        ascending=
-        {
-            'ASC': True,
-            'DESC': False
-        }[sort_order])
-
-    if search_text:
-        prices = prices[lowertrim(prices['Name']).str.contains(lowertrim(search_text))]
-        
-    table_md = '\n'.join(generate_md_header(prices.columns) + prices.apply(generate_md_row, axis=1).values.tolist())
+    # From the registry: the view is only republished when prices change, so its LastUpdate lags
+    last_updates = [get_last_update(tracked_collections[name].nft_prices_csv) for name in collection_prices]
+    if None not in last_updates:
+        last_price_update_time = min(last_updates).strftime("%Y-%m-%d %H:%M")
+    # Sort permutations and search index are built once per snapshot and shared by all sessions
+    price_index = frame_cache.get(
+        ('price_index', prices_key), lambda: PriceIndex(prices, ['OS ETH', 'Arb', *price_sort_map.values()]))
+    query = dict(
+        sort_col=price_sort_map.get(sort_option, sort_option),
+        ascending={'ASC': True, 'DESC': False}[sort_order],
+        max_eth=max_eth,
+        arb_only=arb_only,
+        search_text=search_text,
+        page_size=page_size)
+    page_rows, n_matches = price_index.query(page=page - 1, **query)
+    if len(page_rows) == 0 and n_matches:
+        # Past the last page (e.g. after narrowing the filters)
+        page = (n_matches - 1) // page_size + 1
+        page_rows, n_matches = price_index.query(page=page - 1, **query)
+    first_row = (page - 1) * page_size
+    page_text = f'Showing {first_row + min(len(page_rows), 1)}-{first_row + len(page_rows)} of {n_matches} items'
+    page_rows = add_trend_column(page_rows)
+    table_md = table_renderer.render(page_rows)
 
 notif_text = st.empty()
 f'### Last Price Update: {last_price_update_time}'
+st.write(page_text)
 st.write(table_md, unsafe_allow_html=True)
 
-def get_countdown():
-    return ((page_last_refresh_time + timedelta(seconds=page_refresh_interval)) - datetime.now()).total_seconds()
-
-with open('data/chime.wav', "rb") as f:
-    audio_bytes = f.read()
+if prices is not None and len(page_rows) > 0:
+    # Drill-down into one item of the page, read from the rollups
+    history_items = dict(zip(
+        [f'{name} (#{token_id})' for name, token_id in zip(page_rows.Name, page_rows.token_id)],
+        zip(row_collections(page_rows), page_rows.token_id.astype(str))))
+    cols = st.columns([0.8, 0.2])
+    with cols[0]:
+        history_item = st.selectbox('Price History', options=list(history_items))
+    with cols[1]:
+        history_resolution = st.selectbox('Resolution', options=list(resolutions), index=1)
+    history_collection, history_token_id = history_items[history_item]
+    history = price_history.history(
+        history_collection, history_token_id, resolution=history_resolution,
+        start=datetime.now().timestamp() - history_chart_window_sec[history_resolution])
+    if len(history) > 0:
+        st.altair_chart(history_chart(history, history_item), use_container_width=True)
+    else:
+        st.write('No history yet')
 
-audio_html = f"""
-    <audio autoplay=True loop>
-    <source src="data:audio/ogg;base64,{base64.b64encode(audio_bytes).decode()}" type="audio/ogg" autoplay=True>
-    Your browser does not support the audio element.
-    </audio>
-"""
 audio_widget = st.empty()
-while get_countdown() <= page_refresh_interval:
-    if prices is not None and len(prices[prices.DTC < dtc_warn_threshold]) > 0:
-        notif_text.write(f'Check DTC < {dtc_warn_threshold} !!! Refresh in ~{round(get_countdown())}s')
-        audio_widget.write(audio_html, unsafe_allow_html=True)
-    else:
-        notif_text.write(f'Will refresh in ~{round(get_countdown())}s')
-        audio_widget.empty()
-    sleep(1)
-    notif_text.empty()
\ No newline at end of file
+fired_alerts = alert_engine.poll(st.session_state.alert_session_id)
+if fired_alerts:
+    alert_desc = f'DTC < {dtc_warn_threshold}' + (f' or Arb > ${arb_warn_threshold}' if arb_warn_threshold else '')
+    notif_text.write(f'Check {alert_desc} ({len(fired_alerts)} items) !!! Refresh every {page_refresh_interval}s')
+    audio_widget.write(alert_audio_html(), unsafe_allow_html=True)
+else:
+    notif_text.write(f'Will refresh every {page_refresh_interval}s')
+
+ui_rerun_seconds.observe(perf_counter() - rerun_start)
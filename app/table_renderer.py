@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+md_exclude_headers = [
+    'token_id', 'LastUpdate', 'OS Link', 'OS Qty', 'GS Link', 'GS Qty',
+    # Native amounts kept for repricing
+    'OS Token', 'OS Amount', 'OS LastSale Token', 'OS LastSale Amount', 'GS Token', 'GS Amount',
+    'GS Fee ETH', 'GS Mint Fee ETH',
+    # Shown inside the Reward cell
+    'Reward USD']
+
+_thousands_re = r'(\d)(?=(\d{3})+(?!\d))'
+
+
+def format_num(values, fmt, thousands=False):
+    # Vectorized equivalent of f'{v:{fmt}}' (with ',' if thousands) for float arrays
+    s = pd.Series(np.char.mod(f'%{fmt}', np.asarray(values, dtype=float)))
+    if thousands:
+        s = s.str.replace(_thousands_re, r'\1,', regex=True)
+    return s
+
+
+def format_qty(qty):
+    s = format_num(np.maximum(np.asarray(qty, dtype=float), 0), '.0f')
+    return s.where(~s.isin(['0', 'nan']), '⚠️')
+
+
+class TableRenderer:
+    # Renders the price table as markdown, one column at a time. Rendered rows
+    # are cached by row content so unchanged rows are not formatted again.
+    def __init__(self, exclude_headers=md_exclude_headers, max_cached_rows=100000):
+        self.exclude_headers = exclude_headers
+        self.max_cached_rows = max_cached_rows
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def header(self, cols):
+        cols = [c for c in cols if c not in self.exclude_headers]
+        return [
+            ('|' + '|'.join(cols) + '|'),
+            ('|' + '|'.join('---' for _ in cols) + '|')
+        ]
+
+    def format_columns(self, df):
+        formatters = {
+            'OS ETH': lambda v: format_num(v, '.4f'),
+            'OS USD': lambda v: '$' + format_num(v, '.0f', thousands=True),
+            'OS LastSale USD': lambda v: '$' + format_num(v, '.0f', thousands=True),
+            'GS USD': lambda v: '$' + format_num(v, '.0f', thousands=True),
+            'OS Change': lambda v: format_num(v, '.1f', thousands=True) + '%',
+            'Reward': lambda v: format_num(v, '.0f') + ' ($' + format_num(df['Reward USD'], '.1f') + ')',
+            'DTC': lambda v: format_num(v, '.1f'),
+            'Arb': lambda v: '$' + format_num(v, '.0f', thousands=True),
+            'Name': lambda v: (
+                v.astype(str).values + '<br/>([OS:' + format_qty(df['OS Qty']) + '](' + df['OS Link'].astype(str).values +
+                '), [GS:' + format_qty(df['GS Qty']) + '](' + df['GS Link'].astype(str).values + '))'),
+        }
+        cells = []
+        for c in df.columns:
+            if c in self.exclude_headers:
+                continue
+            col = formatters[c](df[c]) if c in formatters else df[c].astype(str)
+            cells.append(pd.Series(np.asarray(col, dtype=object)))
+        if not cells:
+            return pd.Series(['||'] * len(df), dtype=object)
+        rows = '|' + cells[0]
+        for col in cells[1:]:
+            rows = rows + '|' + col
+        return rows + '|'
+
+    def render_rows(self, df):
+        if len(df) == 0:
+            return []
+        # Row content hash, salted with everything else the output depends on
+        salt = hash(tuple(df.columns))
+        keys = [(salt, k) for k in pd.util.hash_pandas_object(df, index=False).values.tolist()]
+        with self._lock:
+            rows = [self._rows.get(k) for k in keys]
+        missing = [i for i, r in enumerate(rows) if r is None]
+        if missing:
+            rendered = self.format_columns(df.iloc[missing]).tolist()
+            with self._lock:
+                for i, r in zip(missing, rendered):
+                    rows[i] = r
+                    self._rows[keys[i]] = r
+                while len(self._rows) > self.max_cached_rows:
+                    self._rows.popitem(last=False)
+        return rows
+
+    def render(self, df):
+        return '\n'.join(self.header(df.columns) + self.render_rows(df))
+
+
+table_renderer = TableRenderer()
@@ -0,0 +1,67 @@
+import os
+import json
+from datetime import datetime
+
+import pandas as pd
+
+
+def matches_trait_filter(traits, trait_filter):
+    return all(traits.get(k) == v for k, v in trait_filter.items())
+
+
+class TokenCatalog:
+    # Every token seen in a collection: token_id -> name, Gala baseId, traits ({trait_type: value})
+    # and first/last seen time. Stored as CSV next to the collection's datasets.
+    columns = ['token_id', 'name', 'base_id', 'traits', 'first_seen', 'last_seen']
+
+    def __init__(self, file):
+        self.file = file
+        self.tokens = {}
+        if os.path.isfile(file):
+            df = pd.read_csv(file, dtype=str, keep_default_na=False)
+            for r in df.to_dict('records'):
+                r['traits'] = json.loads(r['traits'] or '{}')
+                self.tokens[r['token_id']] = r
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token_id):
+        return token_id in self.tokens
+
+    def token_ids(self):
+        return list(self.tokens)
+
+    def upsert(self, records, seen_at=None):
+        # records: dicts with token_id, name, base_id and traits; returns the token IDs that were new
+        seen_at = seen_at or datetime.now().isoformat()
+        new_token_ids = []
+        for r in records:
+            token = self.tokens.get(r['token_id'])
+            if token is None:
+                token = self.tokens[r['token_id']] = dict(r, first_seen=seen_at)
+                new_token_ids.append(r['token_id'])
+            else:
+                # A token without sell orders has no baseId in its record; keep the known one
+                token.update({k: v for k, v in r.items() if v or k != 'base_id'})
+            token['last_seen'] = seen_at
+        return new_token_ids
+
+    def select(self, name_filter=None, trait_filter=None):
+        return [
+            token_id for token_id, token in self.tokens.items()
+            if (name_filter is None or (token['name'] and name_filter(token['name']))) and
+            (not trait_filter or matches_trait_filter(token['traits'], trait_filter))
+        ]
+
+    def base_ids(self):
+        return {token_id: token['base_id'] for token_id, token in self.tokens.items() if token['base_id']}
+
+    def save(self):
+        df = pd.DataFrame(
+            [dict(token, traits=json.dumps(token['traits'])) for token in self.tokens.values()],
+            columns=self.columns)
+        os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+        tmp_file = f'{self.file}.{os.getpid()}.tmp'
+        df.to_csv(tmp_file, index=False)
+        os.replace(tmp_file, self.file)
@@ -0,0 +1,93 @@
+import os
+import json
+import fcntl
+from time import time
+
+
+def merge_entries(entries, newer):
+    # Per key, the entry written last wins
+    merged = dict(entries)
+    for k, entry in newer.items():
+        if k not in merged or entry[0] >= merged[k][0]:
+            merged[k] = entry
+    return merged
+
+
+class PersistentTTLCache:
+    # Small JSON-backed key/value cache shared between background_updater runs and
+    # the scheduler's worker processes. Reads pick up what other processes saved
+    # (the file is re-read when it changes); saves merge this process's new entries
+    # into the file under a lock instead of overwriting it.
+    # Entries are kept after they expire so callers can still fall back to them.
+    def __init__(self, file, ttl_sec):
+        self.file = file
+        self.ttl_sec = ttl_sec
+        self._entries = {}
+        self._unsaved = {}
+        self._file_key = None
+        self.load()
+
+    def _stat_key(self):
+        try:
+            st = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read_file(self):
+        try:
+            with open(self.file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print(f'Warning: discarding corrupt cache {self.file}')
+            return {}
+
+    def load(self):
+        self._file_key = self._stat_key()
+        self._entries = merge_entries(self._read_file(), self._unsaved)
+
+    def _refresh(self):
+        if self._stat_key() != self._file_key:
+            self.load()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+        with open(f'{self.file}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = merge_entries(self._read_file(), self._unsaved)
+            tmp_file = f'{self.file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_file, self.file)
+            self._file_key = self._stat_key()
+        self._entries = entries
+        self._unsaved = {}
+
+    def age(self, key):
+        self._refresh()
+        entry = self._entries.get(key)
+        return None if entry is None else time() - entry[0]
+
+    def get(self, key, default=None, allow_stale=False):
+        self._refresh()
+        entry = self._entries.get(key)
+        if entry is None or (not allow_stale and time() - entry[0] > self.ttl_sec):
+            return default
+        return entry[1]
+
+    def get_many(self, keys, allow_stale=False):
+        self._refresh()
+        missing = object()
+        found = {k: self.get(k, missing, allow_stale=allow_stale) for k in keys}
+        return {k: v for k, v in found.items() if v is not missing}
+
+    def set(self, key, value):
+        entry = [time(), value]
+        self._entries[key] = entry
+        self._unsaved[key] = entry
+
+    def set_many(self, items):
+        for k, v in items.items():
+            self.set(k, v)
@@ -1,40 +1,130 @@
 from wsgiref import headers
-import requests
 import os
 import json
 import numpy as np
 import pandas as pd
 from multiprocessing.pool import ThreadPool
-from http.cookies import SimpleCookie
+from collections import deque
+from itertools import count
 import re
+import hashlib
 from urllib.parse import urlencode
 from datetime import datetime, timedelta
 
-from time import sleep
+from name_index import NameIndex, get_name_index
+from ttl_cache import PersistentTTLCache
+from fee_estimator import FeeEstimator
+from http_client import HttpClient
+from snapshot_store import SnapshotStore
+from published_snapshots import PublishedSnapshots
+from price_history import PriceHistory
+from background_state import BackgroundStateDB
+from collection_registry import load_collections, shared_coin_prices_csv
+from rate_limit import HostGovernor, host_limits
+from token_catalog import matches_trait_filter
+from asset_record import AssetRecord
+import metrics
+from metrics import span
 
 with open('config.json', 'r') as f:
     config = json.loads(f.read())
 
 nan = float('nan')
 
+cache_dir = config.get('cache_dir', 'data/cache')
+
+http_session = HttpClient(
+    cache_dir=os.path.join(cache_dir, 'http'),
+    timeout=config.get('http_timeout', 30),
+    max_retries=config.get('http_max_retries', 5),
+    cache_max_age_sec=config.get('http_cache_max_age_sec', 7 * 86400),
+    cache_max_bytes=config.get('http_cache_max_bytes', 512 * 1024 ** 2))
+# Per-process governor; the scheduler replaces it with one shared by its workers
+http_session.governor = HostGovernor(host_limits(config.get('rate_limits', {})))
+
+data_dir = config.get('data_dir', 'data')
+tracked_collections = load_collections(config, data_dir=data_dir)
+default_coin_prices_csv = shared_coin_prices_csv(data_dir)
+published_snapshots = PublishedSnapshots(os.path.join(data_dir, 'published'))
+coin_prices_view = 'coin_prices'
+# Rollups of the published prices for charts; see PriceHistory for the retention per resolution
+price_history = PriceHistory(os.path.join(data_dir, 'price_history.sqlite3'), config.get('history_retention_days', {}))
+tracked_coins = config.get('coins', ['ethereum', 'gala', 'town-star'])
+# Payment token symbol -> tracked coin, for repricing from coin prices
+coin_symbols = config.get('coin_symbols', {'ETH': 'ethereum', 'WETH': 'ethereum', 'GALA': 'gala', 'TOWN': 'town-star'})
+
+# Print span timings of background jobs (also enabled by SPACESQUID_TRACE=1)
+metrics.trace_spans = config.get('trace_spans', False) or os.environ.get('SPACESQUID_TRACE') == '1'
+
+# Upstream base URLs; overridable e.g. to point at a local stand-in server
+opensea_api_url = config.get('opensea_api_url', 'https://api.opensea.io/api/v1')
+gala_api_url = config.get('gala_api_url', 'https://walletsrv.gala.games')
+coingecko_api_url = config.get('coingecko_api_url', 'https://api.coingecko.com/api/v3')
+nftlookup_url = config.get('nftlookup_url', 'https://nftlookup.io/nftlookup')
+
 opensea_commission = 0.025
 opensea_townstar_commission = 0.025
 
 def has_expired(file, threshold_sec, load_func=pd.read_csv):
-    df = load_file(file, load_func=load_func)
-    if df is None:
+    last_update = get_last_update(file, load_func=load_func)
+    if last_update is None:
         # No data = much fetch = expired
         return True
-    last_update = datetime.fromisoformat(df.iloc[0].LastUpdate)
     return datetime.now() > (last_update + timedelta(seconds=threshold_sec))
 
 
-def load_file(file, load_func, patient=False, wait_sec=1):
-    while patient and not os.path.isfile(file):
-        sleep(wait_sec)
+def get_last_update(file, load_func=pd.read_csv):
+    state = BackgroundStateDB().get_dataset_state(file)
+    if state is None or state['last_update'] is None:
+        # Not in the registry yet (e.g. fresh DB): seed it from the file once
+        df = load_file(file, load_func=load_func)
+        if df is None:
+            return None
+        record_dataset_update(file, df)
+        return datetime.fromisoformat(df.iloc[0].LastUpdate)
+    return datetime.fromisoformat(state['last_update'])
+
+
+def get_data_age(file):
+    last_update = get_last_update(file)
+    return None if last_update is None else datetime.now() - last_update
+
+
+def hash_frame(df):
+    # Content hash ignoring LastUpdate, so unchanged data hashes the same across runs
+    row_hashes = pd.util.hash_pandas_object(df.drop(columns='LastUpdate', errors='ignore'), index=False)
+    return hashlib.sha1(row_hashes.values.tobytes()).hexdigest()
+
+
+def record_dataset_update(file, df):
+    BackgroundStateDB().record_dataset_update(file, df.LastUpdate.iloc[0], len(df), hash_frame(df))
+
+
+def load_file(file, load_func):
     return load_func(file) if os.path.isfile(file) else None
 
 
+def write_csv_atomic(df, file):
+    tmp_file = f'{file}.{os.getpid()}.tmp'
+    df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, file)
+
+
+def get_snapshot_store(csv_file, index_col='token_id'):
+    # Snapshot history lives next to the CSV, e.g. data/town-star/nft_prices/
+    base_dir, filename = os.path.split(csv_file)
+    return SnapshotStore(base_dir, os.path.splitext(filename)[0], index_col=index_col,
+                         full_days=config.get('snapshot_full_days', 2),
+                         retention_days=config.get('snapshot_retention_days', 30))
+
+
+def save_dataset(df, csv_file, index_col='token_id'):
+    # Append the snapshot to the history store and replace the latest CSV atomically
+    get_snapshot_store(csv_file, index_col=index_col).append(df, datetime.fromisoformat(df.LastUpdate.iloc[0]))
+    write_csv_atomic(df, csv_file)
+    record_dataset_update(csv_file, df)
+
+
 def read_json(file):
     with open(file, 'r') as f:
         return json.load(f)
@@ -45,6 +135,10 @@ def write_json(file, data):
         json.dump(data, f)
 
 
+def get_coin_price(coin_prices, coin, symbol='usd'):
+    return coin_prices[coin_prices.coin == coin].iloc[0][symbol]
+
+
 def lowertrim(s):
     if isinstance(s, pd.Series):
         return s.str.lower().str.strip()
@@ -52,216 +146,459 @@ def lowertrim(s):
         return s.lower().strip()
 
 
-def fetch_opensea_assets(
-        reward_item_names,
+def add_reward_columns(prices, rewards, reward_usd):
+    prices = prices.copy()
+    if rewards is None or len(rewards) == 0:
+        # Collection without a reward source
+        prices['Reward'] = nan
+        prices['Reward USD'] = nan
+        prices['DTC'] = nan
+        return prices
+    reward_index = get_name_index(
+        ('rewards', rewards.LastUpdate.iloc[0], len(rewards), rewards.name.iloc[0]), rewards.name.values)
+
+    def get_reward(name):
+        match_pos = reward_index.match(name)
+        if not match_pos:
+            print(f'Warning: Reward info unavailable for {name}')
+            return float('nan')
+        r = rewards.iloc[match_pos]
+        n = len(r)
+        if n > 1:
+            print(f'Warning: {name} has {n} reward matches: {r}')
+        return float(r.reward.iloc[0])
+
+    prices['Reward'] = prices.Name.map(get_reward)
+    # In the collection's own reward coin
+    prices['Reward USD'] = prices.Reward * reward_usd
+    prices['DTC'] = prices['OS USD'] / prices['Reward USD']
+    return prices
+
+
+def fetch_opensea_page(params):
+    url = f'{opensea_api_url}/assets?{params}'
+    print(f'Fetching url: {url}')
+    r = http_session.get(url, headers={
+        'X-API-KEY': config['opensesa_api_key']
+    }, cache=True, max_retries=config.get('opensea_max_retries', 10))
+    assert r.status_code == 200, f'Failed to fetch assets. Code={r.status_code}, reason={r.reason}'
+    # Project in the fetching thread so the raw page can be dropped right away
+    return [AssetRecord.from_opensea(a) for a in r.json()['assets']]
+
+
+def filter_opensea_assets(assets, reward_index, trait_filter):
+    # reward_index=None keeps assets regardless of name
+    return [
+        a for a in assets
+        if isinstance(a.name, str) and
+        (reward_index is None or reward_index.has_substring(a.name)) and
+        matches_trait_filter(a.traits, trait_filter)
+    ]
+
+
+def imap_until_empty(pool, func, args_iter, window, is_end=lambda result: len(result) == 0):
+    # Like pool.imap but keeps at most `window` calls in flight and stops
+    # issuing new ones once a result (in order) comes back empty (or is_end)
+    args_iter = iter(args_iter)
+    pending = deque()
+
+    def submit():
+        try:
+            pending.append(pool.apply_async(func, (next(args_iter),)))
+        except StopIteration:
+            pass
+
+    for _ in range(window):
+        submit()
+    while pending:
+        result = pending.popleft().get()
+        if is_end(result):
+            # Anything still in flight is past the end; drop it
+            break
+        yield result
+        submit()
+
+
+def fetch_opensea_pages(
         token_ids=[],
         collection='town-star',
-        contract_address='0xc36cf0cfcb5d905b8b513860db0cfe63f6cf9f5c'):
-    offset = 0
+        contract_address='0xc36cf0cfcb5d905b8b513860db0cfe63f6cf9f5c',
+        concurrency=config.get('opensea_concurrency', 4),
+        known_token_ids=None):
+    # Yields pages of AssetRecords: the given token_ids, or else a walk over the collection newest
+    # first that stops at the first page without tokens outside known_token_ids
     limit = 50  # Max for opensea API
     token_id_blocksize = 30
     assert token_id_blocksize <= limit  # Because if not, paging loop will be needed
-    wanted_assets = []
-    # Paging loop
-    while True:
-        base_params = urlencode(dict(
+
+    def page_params(offset, ti_param=''):
+        params = urlencode(dict(
             collection=collection,
             asset_contract_address=contract_address,
             order_direction='desc',
             limit=limit,
             offset=offset
         ))
-        print(f'Fetching offset={offset}')
-        ti_param_list = ['']
+        if ti_param:
+            params += '&' + ti_param
+        return params
+
+    def is_end(assets):
+        return all(a.token_id in known_token_ids for a in assets) if known_token_ids else len(assets) == 0
+
+    with ThreadPool(max(concurrency, 1)) as pool:
         if len(token_ids) > 0:
+            # Each token_ids block fits in a single page because token_id_blocksize <= limit
             ti_param_list = [
                 '&'.join(f'token_ids={ti}' for ti in token_ids[ti_block:ti_block+token_id_blocksize])
                 for ti_block in range(0, len(token_ids), token_id_blocksize)
             ]
-        # token_ids loop
-        for ti_param in ti_param_list:
-            params = base_params
-            if ti_param:
-                params += '&' + ti_param
-            while True:
-                url = f'https://api.opensea.io/api/v1/assets?{params}'
-                print(f'Fetching url: {url}')
-                r = requests.get(url, headers={
-                    'X-API-KEY': config['opensesa_api_key']
-                })
-                status_code = r.status_code
-                if str(status_code) == '200':
-                    break
-                if 'Gateway Time-out' in r.reason:
-                    print(f'Gateway Time-out (params={params}); sleeping 60s...')
-                    sleep(60)
-                else:
-                    print(f'Failed to fetch assets. Code={status_code}, reason={r.reason}')
-                    sleep(10)
-
-            assert r.status_code == 200, r.reason
-            assets = r.json()['assets']
-            if len(assets) == 0:
-                break
-            for a in assets:
-                if not ('name' in a and
-                        isinstance(a['name'], str) and
-                        any(lowertrim(a['name']) in n for n in reward_item_names)):
-                    continue
-                df = pd.DataFrame(a['traits'])
-                try:
-                    df = df.set_index('trait_type')[['value']].T
-                    if df.iloc[0].game == 'Town Star':
-                        wanted_assets.append(a)
-                except (KeyError, AttributeError):
-                    continue
-            sleep(0.1)
-        if len(token_ids) > 0 or len(assets) == 0:
-            # token_ids loop would have gone through all pages by itself
-            # because token_id_blocksize <= limit
-            break
-        offset += limit
+            print(f'Fetching {len(ti_param_list)} token_id blocks')
+            yield from pool.imap(fetch_opensea_page, [page_params(0, ti_param) for ti_param in ti_param_list])
+        else:
+            # Incremental walks usually end on the first page, so don't fetch ahead
+            window = 1 if known_token_ids else concurrency
+            yield from imap_until_empty(
+                pool, fetch_opensea_page, (page_params(offset) for offset in count(0, limit)), window, is_end)
+
+
+def fetch_opensea_assets(
+        reward_item_names,
+        token_ids=[],
+        collection='town-star',
+        contract_address='0xc36cf0cfcb5d905b8b513860db0cfe63f6cf9f5c',
+        trait_filter={'game': 'Town Star'},
+        concurrency=config.get('opensea_concurrency', 4)):
+    reward_index = None if reward_item_names is None else NameIndex(reward_item_names)
+    wanted_assets = []
+    for assets in fetch_opensea_pages(token_ids, collection, contract_address, concurrency):
+        wanted_assets.extend(filter_opensea_assets(assets, reward_index, trait_filter))
     return wanted_assets
 
 
-def get_nft_prices(assets, coin_prices):
-    gs_fee = fetch_gala_store_txn_fee(coin_prices)
-    gs_mint_fee = fetch_gala_mint_fee(coin_prices)
-
-    def thread_work(a):
-        sell_orders = a['sell_orders']
-        os_price_eth = nan
-        os_price_usd = nan
-        os_qty = nan
-        os_last_sale_usd = nan
-        gs_link = 'N/A'
-        gs_usd = nan
-        gs_qty = nan
-        if sell_orders:
-            cheapest_so_idx = np.argmin([parse_sell_order_price(so, symbol='usd') for so in sell_orders])
-            cheapest_so = sell_orders[cheapest_so_idx]
-            os_price_eth = parse_sell_order_price(cheapest_so, symbol='eth')
-            os_price_usd = parse_sell_order_price(cheapest_so, symbol='usd')
-            os_qty = int(cheapest_so['quantity'])
-            last_sale = a['last_sale']
-            # last_sale_eth = parse_last_sale_price(last_sale, symbol='eth')
-            os_last_sale_usd = parse_last_sale_price(last_sale, symbol='usd') if last_sale else nan
-            # last_sale_qty = float(last_sale['quantity'])
-            gs_link, gs_usd, gs_qty = fetch_gala_store_price(cheapest_so, name=a['name'])
-        else:
-            print(f'Warning: {a["name"]} has no sell orders')
-        return [
-            a['token_id'],
-            a['name'],
-            a['permalink'],
-            os_price_eth,
-            os_price_usd,
-            os_last_sale_usd,
-            max(os_qty, 0),
-            100 * (os_price_usd - os_last_sale_usd) / os_last_sale_usd,
-            gs_link,
-            gs_usd,
-            max(gs_qty, 0),
-            min(os_last_sale_usd, os_price_usd) * (1 - opensea_commission - opensea_townstar_commission) -
-            (gs_usd + gs_fee + gs_mint_fee)
-        ]
-    with ThreadPool(16) as pool:
-        data = [i for i in pool.map(thread_work, assets) if i is not None]
+def catalog_record(asset):
+    # Token catalog entry for an AssetRecord
+    base_id = asset.sell_orders[0].base_id if asset.sell_orders else ''
+    return dict(
+        token_id=asset.token_id,
+        name=asset.name or '',
+        # Orders without calldata have no Gala item
+        base_id=base_id if base_id != '0x' else '',
+        traits=asset.traits,
+    )
+
 
-    return pd.DataFrame(data, columns=[
-        'token_id',
-        'Name', 'OS Link',
-        'OS ETH', 'OS USD', 'OS LastSale USD', 'OS Qty', 'OS Change',
-        'GS Link', 'GS USD', 'GS Qty', 'Arb'])
+def fetch_opensea_changed_token_ids(
+        occurred_after,
+        collection='town-star',
+        contract_address='0xc36cf0cfcb5d905b8b513860db0cfe63f6cf9f5c',
+        max_pages=20):
+    # Token IDs with any OpenSea event (listing, sale, cancellation, transfer...) since occurred_after.
+    # Returns None if there are more changes than max_pages can hold; caller should do a full scan then.
+    token_ids = []
+    cursor = None
+    for _ in range(max_pages):
+        params = dict(
+            collection_slug=collection,
+            asset_contract_address=contract_address,
+            occurred_after=int(occurred_after),
+            limit=50
+        )
+        if cursor:
+            params['cursor'] = cursor
+        url = f'{opensea_api_url}/events?{urlencode(params)}'
+        print(f'Fetching url: {url}')
+        r = http_session.get(url, headers={
+            'X-API-KEY': config['opensesa_api_key']
+        })
+        assert r.status_code == 200, f'Failed to fetch events. Code={r.status_code}, reason={r.reason}'
+        data = r.json()
+        for e in data.get('asset_events') or []:
+            asset = e.get('asset') or {}
+            if asset.get('token_id') is not None:
+                token_ids.append(str(asset['token_id']))
+        cursor = data.get('next')
+        if not cursor:
+            return list(dict.fromkeys(token_ids))
+    print(f'More than {max_pages} pages of events since {occurred_after}')
+    return None
+
+
+def payment_columns(payments):
+    # Columnar Payment.price over many orders or sales; also returns the price per unit in
+    # the payment token itself
+    amount = np.array([p.amount for p in payments], dtype=float)
+    usd_rate = np.array([p.usd_rate for p in payments], dtype=float)
+    eth_rate = np.array([p.eth_rate for p in payments], dtype=float)
+    scale = np.power(10.0, [p.decimals for p in payments])
+    qty = np.array([p.quantity for p in payments], dtype=np.int64)
+    return amount * usd_rate / scale / qty, amount * eth_rate / scale / qty, qty, amount / scale / qty
+
+
+def cheapest_sell_order_columns(assets):
+    # Flattens the sell orders of all assets and picks each asset's cheapest order (in USD)
+    # with a grouped argmin; ties go to the first order, as with np.argmin
+    n = len(assets)
+    cheapest = [None] * n
+    usd = np.full(n, nan)
+    eth = np.full(n, nan)
+    qty = np.full(n, nan)
+    amount = np.full(n, nan)
+    orders = [(i, so) for i, a in enumerate(assets) for so in a.sell_orders]
+    if orders:
+        owner = np.array([i for i, _ in orders], dtype=np.int64)
+        order_usd, order_eth, order_qty, order_amount = payment_columns([so for _, so in orders])
+        by_price = np.lexsort((order_usd, owner))
+        first = by_price[np.unique(owner[by_price], return_index=True)[1]]
+        has_orders = owner[first]
+        usd[has_orders] = order_usd[first]
+        eth[has_orders] = order_eth[first]
+        qty[has_orders] = order_qty[first]
+        amount[has_orders] = order_amount[first]
+        for i, j in zip(has_orders, first):
+            cheapest[i] = orders[j][1]
+    return cheapest, usd, eth, qty, amount
+
+
+def last_sale_columns(assets, cheapest_sell_orders):
+    usd = np.full(len(assets), nan)
+    amount = np.full(len(assets), nan)
+    sold = [i for i, (a, so) in enumerate(zip(assets, cheapest_sell_orders)) if so is not None and a.last_sale]
+    if sold:
+        sale_usd, _, _, sale_amount = payment_columns([assets[i].last_sale for i in sold])
+        usd[sold] = sale_usd
+        amount[sold] = sale_amount
+    return usd, amount
+
+
+def arb_usd(os_last_sale_usd, os_price_usd, gs_usd, gs_fee_usd, gs_mint_fee_usd):
+    # Profit from buying on Gala Store (plus fees) and selling on OpenSea
+    return np.minimum(os_last_sale_usd, os_price_usd) * (1 - opensea_commission - opensea_townstar_commission) - \
+        (gs_usd + gs_fee_usd + gs_mint_fee_usd)
+
+
+def get_nft_prices(assets, coin_prices, base_ids={}):
+    # base_ids: known token_id -> Gala baseId (e.g. from the token catalog); others come from the sell order.
+    # Native amounts (per unit, in the payment token) and fees in ETH are kept next to the USD
+    # values so reprice_nft_prices can follow coin prices without fetching again.
+    with span('gala_fees'):
+        # Estimate once per pass and convert to USD like repricing does
+        gs_fee_eth, gs_mint_fee_eth = get_gala_fees_eth()
+        eth_usd = get_coin_price(coin_prices, 'ethereum')
+        gs_fee, gs_mint_fee = gs_fee_eth * eth_usd, gs_mint_fee_eth * eth_usd
+
+    with span('cheapest_orders'):
+        cheapest_sell_orders, os_price_usd, os_price_eth, os_qty, os_amount = cheapest_sell_order_columns(assets)
+        os_last_sale_usd, os_last_sale_amount = last_sale_columns(assets, cheapest_sell_orders)
+
+    # Only the Gala Store lookups need the network (batched and threaded in fetch_gala_store_products)
+    with span('gala_store'):
+        asset_base_ids = [
+            None if so is None else base_ids.get(a.token_id) or so.base_id
+            for a, so in zip(assets, cheapest_sell_orders)
+        ]
+        gs_products = fetch_gala_store_products([base_id for base_id in asset_base_ids if base_id is not None])
+        gs_prices = []
+        gs_native = []
+        for a, base_id in zip(assets, asset_base_ids):
+            if base_id is None:
+                print(f'Warning: {a.name} has no sell orders')
+                gs_prices.append(('N/A', nan, nan))
+                gs_native.append((None, nan))
+            else:
+                product = gs_products.get(base_id, False)
+                gs_prices.append(parse_gala_store_price(base_id, product, name=a.name))
+                gs_native.append(parse_gala_store_native_price(product))
+
+    with span('rows'):
+        gs_link = [p[0] for p in gs_prices]
+        gs_usd = np.array([p[1] for p in gs_prices], dtype=float)
+        gs_qty = np.array([p[2] for p in gs_prices], dtype=float)
+        os_qty = np.maximum(os_qty, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            os_change = 100 * (os_price_usd - os_last_sale_usd) / os_last_sale_usd
+        return pd.DataFrame({
+            'token_id': [a.token_id for a in assets],
+            'Name': [a.name for a in assets],
+            'OS Link': [a.permalink for a in assets],
+            'OS ETH': os_price_eth,
+            'OS USD': os_price_usd,
+            'OS LastSale USD': os_last_sale_usd,
+            # Whole quantities stay integers unless some asset has no sell order
+            'OS Qty': os_qty if np.isnan(os_qty).any() else os_qty.astype(np.int64),
+            'OS Change': os_change,
+            'GS Link': gs_link,
+            'GS USD': gs_usd,
+            'GS Qty': np.maximum(gs_qty, 0),
+            'Arb': arb_usd(os_last_sale_usd, os_price_usd, gs_usd, gs_fee, gs_mint_fee),
+            'OS Token': [None if so is None else so.symbol for so in cheapest_sell_orders],
+            'OS Amount': os_amount,
+            'OS LastSale Token': [
+                a.last_sale.symbol if so is not None and a.last_sale else None
+                for a, so in zip(assets, cheapest_sell_orders)],
+            'OS LastSale Amount': os_last_sale_amount,
+            'GS Token': [n[0] for n in gs_native],
+            'GS Amount': np.array([n[1] for n in gs_native], dtype=float),
+            'GS Fee ETH': gs_fee_eth,
+            'GS Mint Fee ETH': gs_mint_fee_eth,
+        })
+
+
+def reprice_nft_prices(prices, coin_prices):
+    # Recomputes the USD columns, OS Change and Arb of a prices snapshot from its native
+    # amounts and the given coin prices in one vectorized pass, without network calls.
+    # Tokens without a tracked coin price keep the rate they had when fetched.
+    if 'OS Amount' not in prices.columns:
+        # Snapshot from before native amounts were stored
+        return prices
+    coin_usd = dict(zip(coin_prices.coin, coin_prices.usd))
+    symbol_usd = {s: coin_usd[coin] for s, coin in coin_symbols.items() if coin in coin_usd}
+    eth_usd = coin_usd.get('ethereum', nan)
+
+    def repriced(usd_col, amount_col, token_col):
+        rate = prices[token_col].map(symbol_usd).values.astype(float)
+        return np.where(np.isnan(rate), prices[usd_col].values, prices[amount_col].values * rate), ~np.isnan(rate)
+
+    prices = prices.copy()
+    os_usd, os_known = repriced('OS USD', 'OS Amount', 'OS Token')
+    os_last_sale_usd, _ = repriced('OS LastSale USD', 'OS LastSale Amount', 'OS LastSale Token')
+    gs_usd, _ = repriced('GS USD', 'GS Amount', 'GS Token')
+    prices['OS ETH'] = np.where(os_known, os_usd / eth_usd, prices['OS ETH'].values)
+    prices['OS USD'] = os_usd
+    prices['OS LastSale USD'] = os_last_sale_usd
+    prices['GS USD'] = gs_usd
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prices['OS Change'] = 100 * (os_usd - os_last_sale_usd) / os_last_sale_usd
+    prices['Arb'] = arb_usd(
+        os_last_sale_usd, os_usd, gs_usd, prices['GS Fee ETH'].values * eth_usd, prices['GS Mint Fee ETH'].values * eth_usd)
+    return prices
 
 
 def initialize_nftlookup_io():
-    r = requests.get('https://nftlookup.io/nftlookup/NFT_index.cfm')
-    # Get CFID and CFTOKEN
-    cookiestr = re.sub(
-        'HttpOnly(, )?', '',
-        r.headers['Set-Cookie'])
-    cookie = SimpleCookie()
-    cookie.load(cookiestr)
+    url = f'{nftlookup_url}/NFT_index.cfm'
+    r = http_session.get(url)
+    # CFID and CFTOKEN: the host's session keeps them across runs, and the server only
+    # sends Set-Cookie when it starts a new session, so read them from the cookie jar
+    cookies = http_session.session(url).cookies
     # Get curToken
     html = r.content.decode()
     cur_token = re.search('curToken: \'(.+)\'', html).group(1)
-    return dict(curToken=cur_token, **{
-        k: v.value for k, v in cookie.items()
+    return dict(curToken=cur_token, CFID=cookies.get('CFID'), CFTOKEN=cookies.get('CFTOKEN'))
+
+
+gala_store_product_fields = '''
+    baseId
+    name
+    description
+    game
+    qtyLeft
+    purchasingDisabled
+    expiresAt
+    prices {
+    price
+    basePrice
+    usdPriceInCents
+    usdBasePriceInCents
+    symbol
+    }
+'''
+
+gala_store_price_cache = PersistentTTLCache(
+    os.path.join(cache_dir, 'gala_store_products.json'),
+    ttl_sec=config.get('gala_store_price_ttl', 300))
+
+
+def fetch_gala_store_product_batch(base_ids):
+    # One request for many items: each baseId gets its own aliased gameItemProducts field
+    var_defs = ', '.join(f'$input{i}: GameItemProductsInput' for i in range(len(base_ids)))
+    fields = '\n'.join(
+        f'p{i}: gameItemProducts(gameItemProductsInput: $input{i}) {{ {gala_store_product_fields} }}'
+        for i in range(len(base_ids)))
+    d = json.dumps({
+        'operationName': 'gameItemProducts',
+        'variables': {f'input{i}': {'baseId': base_id} for i, base_id in enumerate(base_ids)},
+        'query': f'query gameItemProducts({var_defs}) {{ {fields} }}'
     })
-
-
-def fetch_gala_store_price(sell_order, name, symbol_preference=['TOWN', 'GALA', 'ETH', 'BAT']):
     h = {
         "content-type": "application/json",
         "pragma": "no-cache",
     }
-    q = '''
-        query gameItemProducts($gameItemProductsInput: GameItemProductsInput) {
-            gameItemProducts(gameItemProductsInput: $gameItemProductsInput) {
-                baseId
-                name
-                description
-                game
-                qtyLeft
-                purchasingDisabled
-                expiresAt
-                prices {
-                price
-                basePrice
-                usdPriceInCents
-                usdBasePriceInCents
-                symbol
-                }
-            }
-        }
-    '''
-    gala_item_id = sell_order['calldata'][166:][:36]
-    d = json.dumps(
-        {
-            "operationName": "gameItemProducts",
-            "variables": {
-                "gameItemProductsInput": {
-                    "baseId": f"0x{gala_item_id}"
-                }
-            },
-            "query": q
-        }
-    )
-    r = requests.post(url='https://walletsrv.gala.games/graphql', headers=h, data=d)
+    print(f'Fetching {len(base_ids)} Gala Store products')
+    r = http_session.post(url=f'{gala_api_url}/graphql', headers=h, data=d)
+    if r.status_code != 200:
+        print(f'Failed to fetch Gala Store products: {r.reason}')
+        return {}
+    data = r.json().get('data') or {}
+    products = {}
+    for i, base_id in enumerate(base_ids):
+        if f'p{i}' in data:
+            # None = Gala Store does not sell this item
+            products[base_id] = (data[f'p{i}'] or [None])[0]
+    return products
+
+
+def fetch_gala_store_products(base_ids, batch_size=50, use_cache=True):
+    base_ids = list(dict.fromkeys(base_ids))
+    products = gala_store_price_cache.get_many(base_ids) if use_cache else {}
+    missing = [b for b in base_ids if b not in products]
+    if missing:
+        batches = [missing[i:i+batch_size] for i in range(0, len(missing), batch_size)]
+        # The governor adapts how many of these actually run at once
+        with ThreadPool(min(len(batches), config.get('gala_concurrency', 8))) as pool:
+            for batch_products in pool.map(fetch_gala_store_product_batch, batches):
+                products.update(batch_products)
+                gala_store_price_cache.set_many(batch_products)
+        gala_store_price_cache.save()
+    print(f'Gala Store products: {len(base_ids) - len(missing)} cached, {len(missing)} fetched')
+    return products
+
+
+def pick_gala_store_price(product, symbol_preference=['TOWN', 'GALA', 'ETH', 'BAT']):
+    # The entry of product['prices'] that is used: the last one in any preferred symbol
+    picked = None
+    for price_data in product['prices']:
+        if any(price_data['symbol'].lower() == pref_sym.lower() for pref_sym in symbol_preference):
+            picked = price_data
+    return picked
+
+
+def parse_gala_store_price(base_id, product, name, symbol_preference=['TOWN', 'GALA', 'ETH', 'BAT']):
+    # product is False if fetching failed and None if Gala Store has no such item
     usd_price = nan
     qty = nan
     effective_symbol = None
-    if r.status_code == 200:
-        try:
-            data = r.json()['data']['gameItemProducts'][0]
-            symbols = []
-            qty = float(data['qtyLeft'])
-            for price_data in data['prices']:
-                sym = price_data['symbol']
-                symbols.append(sym)
-                for pref_sym in symbol_preference:
-                    if sym.lower() == pref_sym.lower():
-                        usd_price = float(price_data['usdPriceInCents'])/100
-                        effective_symbol = pref_sym
-                        break
-            if usd_price is nan:
-                print(f'No {symbol_preference} price available in Gala Store for {name}: only {symbols}')
-        except IndexError:
-            print(f'No price available in Gala Store for {name}')
+    if product:
+        qty = float(product['qtyLeft'])
+        price_data = pick_gala_store_price(product, symbol_preference)
+        if price_data is not None:
+            usd_price = float(price_data['usdPriceInCents'])/100
+            effective_symbol = next(s for s in symbol_preference if s.lower() == price_data['symbol'].lower())
+        else:
+            symbols = [p['symbol'] for p in product['prices']]
+            print(f'No {symbol_preference} price available in Gala Store for {name}: only {symbols}')
+    elif product is None:
+        print(f'No price available in Gala Store for {name}')
     else:
-        print(f'Failed to fetch Gala Store price for {name}: {r.reason}')
-    gs_link = f'https://app.gala.games/games/buy-item/0x{gala_item_id}/?currency={effective_symbol}'
+        print(f'Failed to fetch Gala Store price for {name}')
+    gs_link = f'https://app.gala.games/games/buy-item/{base_id}/?currency={effective_symbol}'
     return gs_link, usd_price, qty
 
 
+def parse_gala_store_native_price(product, symbol_preference=['TOWN', 'GALA', 'ETH', 'BAT']):
+    # (symbol, price in that token) of the price parse_gala_store_price uses, or (None, nan)
+    price_data = pick_gala_store_price(product, symbol_preference) if product else None
+    if price_data is None or price_data.get('price') is None:
+        return None, nan
+    return price_data['symbol'].upper(), float(price_data['price'])
+
+
 def query_gala(data):
     h = {
         'pragma': 'no-cache',
         'content-type': 'application/json',
         'cookie': f'blankUser={config["gala_store_blank_user"]}'
     }
-    return requests.post(url='https://walletsrv.gala.games/gateway', headers=h, data=json.dumps(data))
+    return http_session.post(url=f'{gala_api_url}/gateway', headers=h, data=json.dumps(data))
 
 
 def fetch_gala_store_txn_fee(coin_prices, in_usd=True, symbol='TOWN'):
@@ -288,13 +625,13 @@ def fetch_gala_store_txn_fee(coin_prices, in_usd=True, symbol='TOWN'):
         data = r.json()['data']['transactionFeeEstimate']
         fee = float(data['gasUnitsEstimate']) * float(data['gasPriceEstimate']['low']) / 1e18
         if in_usd:
-            fee *= coin_prices[coin_prices.coin == 'ethereum'].iloc[0].usd
+            fee *= get_coin_price(coin_prices, 'ethereum')
     else:
         print('Failed to get Gala Store transaction fee')
     return fee
 
 
-def fetch_gala_mint_fee(coin_prices, in_usd=True):
+def fetch_gala_claim_fee():
     q = '''
         query getTokenClaimFees($networks: [ClaimNetwork!]) {
         tokenClaimFees(networks: $networks) {
@@ -318,28 +655,28 @@ def fetch_gala_mint_fee(coin_prices, in_usd=True):
         "query": q
     }
     r = query_gala(d)
+    fee = nan
     if r.status_code == 200:
         data = next(i for i in r.json()['data']['tokenClaimFees'][0]['contractTypes']
                     if i['contractType'] == 'erc1155')['nonFungible']
-        send_amount = float(data['minBatchFee']) - float(data['perTokenFee'])
-        txn_fee = fetch_gala_store_txn_fee(coin_prices, in_usd=False, symbol='ITEM')
-        fee = send_amount + txn_fee
-        if in_usd:
-            fee *= coin_prices[coin_prices.coin == 'ethereum'].iloc[0].usd
+        fee = float(data['minBatchFee']) - float(data['perTokenFee'])
     else:
-        print('Failed to get Gala Store miting fee')
+        print('Failed to get Gala Store claim fee')
     return fee
 
 
-def parse_sell_order_price(order, symbol='usd'):
-    return float(order['current_price']) * \
-        float(order['payment_token_contract'][f'{symbol}_price']) \
-        / (10 ** order['payment_token_contract']['decimals']) \
-        / int(order['quantity'])
+gala_fee_estimator = FeeEstimator(
+    os.path.join(cache_dir, 'gala_fees.json'),
+    ttl_sec=config.get('gala_fee_ttl', 600),
+    estimators={
+        'txn_TOWN': lambda: fetch_gala_store_txn_fee(None, in_usd=False, symbol='TOWN'),
+        'txn_ITEM': lambda: fetch_gala_store_txn_fee(None, in_usd=False, symbol='ITEM'),
+        'claim': fetch_gala_claim_fee,
+    })
+
 
+def get_gala_fees_eth():
+    # Returns (transaction fee, mint fee) in ETH
+    return (gala_fee_estimator.estimate_eth('txn_TOWN'),
+            gala_fee_estimator.estimate_eth('claim') + gala_fee_estimator.estimate_eth('txn_ITEM'))
 
-def parse_last_sale_price(sale, symbol='usd'):
-    return float(sale['total_price']) * \
-        float(sale['payment_token'][f'{symbol}_price']) \
-        / (10 ** sale['payment_token']['decimals']) \
-        / int(sale['quantity'])
@@ -0,0 +1,106 @@
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from time import perf_counter
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'app'))
+sys.path.insert(0, bench_dir)
+from stand_in_server import StandInServer
+
+
+def setup_workdir(server, opensea_concurrency):
+    # util reads config.json from the working directory on import
+    workdir = tempfile.mkdtemp(prefix='spacesquid-bench-')
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(dict(
+            opensesa_api_key='bench',
+            gala_store_blank_user='bench',
+            opensea_api_url=f'{server.url}/opensea',
+            gala_api_url=f'{server.url}/gala',
+            coingecko_api_url=f'{server.url}/coingecko',
+            nftlookup_url=f'{server.url}/nftlookup',
+            opensea_concurrency=opensea_concurrency,
+        ), f)
+    os.chdir(workdir)
+    os.makedirs('data', exist_ok=True)
+    return workdir
+
+
+def run_stage(server, name, func, results, track_memory):
+    server.reset_counts()
+    if track_memory:
+        tracemalloc.start()
+    t = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        value = func()
+    wall = perf_counter() - t
+    peak = 0
+    if track_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    results.append(dict(stage=name, wall=wall, requests=sum(server.reset_counts().values()), peak=peak))
+    return value
+
+
+def bench(server, n, track_memory):
+    import util
+    from background_updater import update_coin_prices, update_nft_rewards
+    from table_renderer import TableRenderer
+    import pandas as pd
+
+    server.load(n)
+    # Start cold: no cached Gala Store prices or fee estimates
+    util.gala_store_price_cache._entries = {}
+    util.gala_fee_estimator.cache._entries = {}
+    coin_prices_csv = os.path.join('data', 'coin_prices.csv')
+    nft_rewards_csv = os.path.join('data', 'nft_rewards.csv')
+    results = []
+
+    def fetch():
+        update_coin_prices(coin_prices_csv, *util.tracked_coins)
+        update_nft_rewards(nft_rewards_csv)
+        rewards = pd.read_csv(nft_rewards_csv)
+        assets = util.fetch_opensea_assets(util.lowertrim(rewards.name).values)
+        return pd.read_csv(coin_prices_csv), rewards, assets
+
+    coin_prices, rewards, assets = run_stage(server, 'fetch', fetch, results, track_memory)
+    prices = run_stage(server, 'pricing', lambda: util.get_nft_prices(assets, coin_prices), results, track_memory)
+    prices['LastUpdate'] = '2022-01-01T00:00:00'
+    town_usd = util.get_coin_price(coin_prices, 'town-star')
+    prices = run_stage(
+        server, 'reward join', lambda: util.add_reward_columns(prices, rewards, town_usd), results, track_memory)
+    run_stage(server, 'markdown render', lambda: TableRenderer().render(prices), results, track_memory)
+    return len(assets), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the update pipeline against a local stand-in server')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency-ms', type=float, default=20, help='Added latency per stand-in request')
+    parser.add_argument('--opensea-concurrency', type=int, default=4)
+    parser.add_argument('--no-memory', action='store_true', help='Skip tracemalloc (it slows down the stages)')
+    args = parser.parse_args()
+
+    server = StandInServer(latency_sec=args.latency_ms / 1000).start()
+    workdir = setup_workdir(server, args.opensea_concurrency)
+    print(f'latency={args.latency_ms}ms opensea_concurrency={args.opensea_concurrency}')
+    print(f'{"assets":>7} {"stage":<16} {"wall (s)":>9} {"requests":>9} {"peak (MB)":>10}')
+    for n in args.sizes:
+        n_found, results = bench(server, n, not args.no_memory)
+        assert n_found == n, f'Expected {n} assets, fetched {n_found}'
+        for r in results:
+            peak = f'{r["peak"] / 1024 ** 2:.1f}' if not args.no_memory else '-'
+            print(f'{n:>7} {r["stage"]:<16} {r["wall"]:>9.3f} {r["requests"]:>9} {peak:>10}')
+    server.stop()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
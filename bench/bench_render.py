@@ -0,0 +1,58 @@
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+from table_renderer import TableRenderer
+
+
+def make_prices(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'token_id': [str(i) for i in range(n)],
+        'Name': [f'Item {i}' for i in range(n)],
+        'OS Link': [f'https://opensea.io/assets/0x0/{i}' for i in range(n)],
+        'OS ETH': rng.random(n) * 2,
+        'OS USD': rng.random(n) * 5000,
+        'OS LastSale USD': rng.random(n) * 5000,
+        'OS Qty': rng.integers(0, 5, n).astype(float),
+        'OS Change': (rng.random(n) - 0.5) * 200,
+        'GS Link': [f'https://app.gala.games/games/buy-item/0x{i}/?currency=TOWN' for i in range(n)],
+        'GS USD': rng.random(n) * 5000,
+        'GS Qty': rng.integers(0, 100, n).astype(float),
+        'Arb': (rng.random(n) - 0.5) * 1000,
+        'LastUpdate': '2022-01-01T00:00:00',
+        'Reward': rng.random(n) * 300,
+        'Reward USD': rng.random(n) * 15,
+        'DTC': rng.random(n) * 300,
+    })
+
+
+def timeit(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t = perf_counter()
+        func()
+        best = min(best, perf_counter() - t)
+    return best
+
+
+def bench(n):
+    prices = make_prices(n)
+    cold = timeit(lambda: TableRenderer().render(prices))
+    renderer = TableRenderer()
+    renderer.render(prices)
+    warm = timeit(lambda: renderer.render(prices))
+    # 1% of rows changed since the last render
+    changed = prices.copy()
+    changed.loc[changed.index[::100], 'OS USD'] += 1
+    partial = timeit(lambda: renderer.render(changed), repeat=1)
+    print(f'{n:>6} rows: cold {cold * 1000:8.1f}ms  warm {warm * 1000:8.1f}ms  1% changed {partial * 1000:8.1f}ms')
+
+
+if __name__ == '__main__':
+    for n in [1000, 10000]:
+        bench(n)
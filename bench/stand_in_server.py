@@ -0,0 +1,146 @@
+import os
+import json
+import threading
+from collections import Counter
+from copy import deepcopy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(fixtures_dir, name), 'r') as f:
+        return json.load(f)
+
+
+def gala_item_id(i):
+    return f'{i:036x}'
+
+
+class StandInServer:
+    # Local stand-in for OpenSea, Gala, CoinGecko and nftlookup that replays the
+    # recorded responses in fixtures/, scaled to n_assets, with a fixed per-request latency.
+    # Upstream paths: /opensea, /gala, /coingecko, /nftlookup
+    def __init__(self, n_assets=100, latency_sec=0.0):
+        self.latency_sec = latency_sec
+        self.request_counts = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self.load(n_assets)
+
+    def load(self, n_assets):
+        asset_template = load_fixture('opensea_asset.json')
+        product_template = load_fixture('gala_product.json')
+        self.assets = []
+        self.products = {}
+        for i in range(n_assets):
+            a = deepcopy(asset_template)
+            a['token_id'] = str(i)
+            a['name'] = f'Item {i:05d}'
+            a['permalink'] = f'{asset_template["permalink"][:-1]}{i}'
+            for j, so in enumerate(a['sell_orders']):
+                so['current_price'] = str(int(so['current_price']) * (1 + i % 7) + j)
+                so['calldata'] = '0' * 166 + gala_item_id(i) + '0' * 64
+            p = deepcopy(product_template)
+            p['baseId'] = f'0x{gala_item_id(i)}'
+            p['name'] = a['name']
+            self.assets.append(a)
+            self.products[p['baseId']] = p
+        self.assets_by_id = {a['token_id']: a for a in self.assets}
+        rewards = load_fixture('nftlookup_rewards.json')
+        row_template = rewards['TableData'][0]
+        rewards['TableData'] = [
+            [a['name'], *row_template[1:2], 1 + i % 50, *row_template[3:]] for i, a in enumerate(self.assets)]
+        self.rewards = rewards
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, headers={}):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in headers.items():
+                    for value in (v if isinstance(v, list) else [v]):
+                        self.send_header(k, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self, body=None):
+                url = urlsplit(self.path)
+                upstream = url.path.split('/')[1]
+                with server._lock:
+                    server.request_counts[upstream] += 1
+                if server.latency_sec:
+                    sleep(server.latency_sec)
+                response = server.route(self.command, url.path, parse_qs(url.query), body)
+                if response is None:
+                    self.send_error(404)
+                elif isinstance(response, tuple):
+                    data, headers = response
+                    if 'CFID=' in self.headers.get('Cookie', ''):
+                        # Like ColdFusion: clients with a session get no new cookies
+                        headers = {k: v for k, v in headers.items() if k != 'Set-Cookie'}
+                    self.send_json(data, headers)
+                else:
+                    self.send_json(response)
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def route(self, method, path, query, body):
+        if path == '/opensea/assets':
+            if 'token_ids' in query:
+                return dict(assets=[self.assets_by_id[ti] for ti in query['token_ids'] if ti in self.assets_by_id])
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query.get('limit', ['50'])[0])
+            return dict(assets=self.assets[offset:offset + limit])
+        if path == '/opensea/events':
+            return dict(asset_events=[], next=None)
+        if path == '/coingecko/simple/price':
+            return load_fixture('coingecko_price.json')
+        if path == '/gala/graphql':
+            variables = json.loads(body)['variables']
+            return dict(data={
+                f'p{k[len("input"):]}': [self.products[v['baseId']]] if v['baseId'] in self.products else []
+                for k, v in variables.items()
+            })
+        if path == '/gala/gateway':
+            operation = json.loads(body)['operationName']
+            return load_fixture({
+                'transactionFeeEstimate': 'gala_txn_fee.json',
+                'getTokenClaimFees': 'gala_claim_fees.json',
+            }[operation])
+        if path == '/nftlookup/NFT_index.cfm':
+            return ("curToken: 'stand-in'", {'Set-Cookie': ['CFID=1; HttpOnly', 'CFTOKEN=2; HttpOnly']})
+        if path == '/nftlookup/GeneralComponents/DatabaseFunctions.cfc':
+            return self.rewards
+        return None
+
+    def reset_counts(self):
+        with self._lock:
+            counts = dict(self.request_counts)
+            self.request_counts.clear()
+        return counts